@@ -1,5 +1,6 @@
 from django.forms import ModelForm, Textarea
 from .models import *
+from .widgets import AutocompleteSelect
 
 # Create the form class.
 class RelationshiptypeForm(ModelForm):
@@ -30,11 +31,19 @@ class RoleForm(ModelForm):
     class Meta:
         model = Role
         fields = '__all__'
+        widgets = {
+            'person': AutocompleteSelect('person'),
+            'organisation': AutocompleteSelect('organisation'),
+        }
 
 class AccountForm(ModelForm):
     class Meta:
         model = Account
         fields = '__all__'
+        widgets = {
+            'role': AutocompleteSelect('role'),
+            'billing_org': AutocompleteSelect('organisation'),
+        }
 
 class CatalogForm(ModelForm):
     class Meta:
@@ -45,14 +54,23 @@ class AccessserviceForm(ModelForm):
     class Meta:
         model = AccessService
         fields = '__all__'
+        widgets = {
+            'contractor': AutocompleteSelect('role'),
+        }
 
 class RdsForm(ModelForm):
     class Meta:
         model = RDS
         fields = '__all__'
+        widgets = {
+            'contractor': AutocompleteSelect('role'),
+        }
 
 class NectarForm(ModelForm):
     class Meta:
         model = Nectar
         fields = '__all__'
+        widgets = {
+            'contractor': AutocompleteSelect('role'),
+        }
 
@@ -0,0 +1,117 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+from bman.models import RelationshipType, Relationship, Organisation, Person, Role, Account, SearchTerm
+from bman.models.search import search
+from bman.models.organisation import get_child_ids_of, get_tree_leaves
+
+# Synthetic data is created in a transaction which is always rolled back
+
+
+class Rollback(Exception):
+    pass
+
+
+def measure(func, repeat):
+    """Run func repeat times, returns average seconds and queries of one run"""
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat, len(queries) // repeat
+
+
+def create_tree(size, branching=4):
+    """Create an organisation tree of size nodes and returns the top one"""
+    rel_type, _ = RelationshipType.objects.get_or_create(
+        name='Organisation',
+        defaults=dict(entity_tail='organisation', entity_head='organisation',
+                      forward='is the parent organisation of',
+                      backward='is a sub-organisation of'))
+    orgs = [Organisation.objects.create(name='Benchmark organisation %d' % i) for i in range(size)]
+    for i in range(1, size):
+        Relationship.objects.create(relationshiptype=rel_type, tail_id=orgs[(i - 1) // branching].pk, head_id=orgs[i].pk)
+    return orgs[0]
+
+
+def bench_tree(size, repeat):
+    top = create_tree(size)
+    return [
+        ('recursive get_tree_leaves', lambda: get_tree_leaves(get_child_ids_of(top.pk), Organisation.objects.get)),
+        ('Organisation.get_tree', top.get_tree)
+    ]
+
+
+def create_accounts(size):
+    """Create an organisation which pays for size accounts, half of them are active"""
+    rel_type, _ = RelationshipType.objects.get_or_create(
+        name='Employment', defaults=dict(entity_tail='organisation', entity_head='person'))
+    org = Organisation.objects.create(name='Benchmark billing organisation')
+    for i in range(size):
+        person = Person.objects.create(first_name='Benchmark', last_name='Person %d' % i)
+        role = Role.objects.create(person=person, organisation=org, relationshiptype=rel_type)
+        Account.objects.create(role=role, username='benchmark%d' % i, billing_org=org, status='AT'[i % 2])
+    return org
+
+
+def bench_accounts(size, repeat):
+    org = create_accounts(size)
+
+    def per_account():
+        return {account.username: dict(role_id=account.role.id, fullname=account.role.person.full_name,
+                                       organisation=account.role.organisation.name, email=account.role.email)
+                for account in org.get_all_accounts()}
+
+    return [
+        ('attributes of each account', per_account),
+        ('get_extended_accounts', org.get_extended_accounts),
+        ('get_extended_accounts active', lambda: org.get_extended_accounts(status='A'))
+    ]
+
+
+def bench_search(size, repeat):
+    # bulk_create skips signals, terms are built at once
+    last_names = ['Smith', 'Jones', 'Williams', 'Brown', 'Wilson', 'Taylor', 'Nguyen', 'Johnson']
+    Person.objects.bulk_create([Person(first_name='Person%d' % i, last_name='%s%d' % (last_names[i % 8], i // 8))
+                                for i in range(size)])
+    SearchTerm.rebuild()
+    return [
+        ('icontains scan', lambda: list(Person.objects.filter(
+            Q(first_name__icontains='smith1') | Q(last_name__icontains='smith1'))[:20])),
+        ('prefix search', lambda: search('smith1', 'person')),
+        # one letter is not used as a prefix, it would read terms of most people
+        ('short prefix search', lambda: search('s', 'person'))
+    ]
+
+
+CASES = {
+    'tree': bench_tree,
+    'accounts': bench_accounts,
+    'search': bench_search,
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare time and number of queries of implementations on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('case', choices=sorted(CASES.keys()))
+        parser.add_argument('-s', '--sizes', default='10,100,1000',
+                            help='Comma separated sizes of synthetic data')
+        parser.add_argument('-r', '--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        for size in [int(s) for s in options['sizes'].split(',')]:
+            try:
+                with transaction.atomic():
+                    for name, func in CASES[options['case']](size, options['repeat']):
+                        seconds, queries = measure(func, options['repeat'])
+                        self.stdout.write('%6d %-30s %10.2f ms %8d queries' % (size, name, seconds * 1000, queries))
+                    raise Rollback()
+            except Rollback:
+                pass
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bman.models import OrganisationClosure
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ancestor and descendant table of organisations from existing relationships'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = OrganisationClosure.rebuild()
+        self.stdout.write('Saved %d ancestor and descendant pairs of organisations' % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bman.models import Organisation
+
+
+class Command(BaseCommand):
+    help = 'Set normalised names of organisations which importers resolve names by'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = Organisation.objects.normalise_names()
+        self.stdout.write('Updated %d organisations' % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bman.models import ServiceOwnership
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ownership table of services from existing services, roles, accounts and organisations'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = ServiceOwnership.rebuild()
+        self.stdout.write('Saved ownership of %d services' % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bman.models import SearchTerm
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search terms of names of people and organisations'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = SearchTerm.rebuild()
+        self.stdout.write('Saved %d search terms' % count)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from bman.models import RelationshipType
+from bman.models.graph import bump_version, export
+
+
+class Command(BaseCommand):
+    help = 'Export snapshots of relationships for lookups without database queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-t', '--type',
+                            action='append',
+                            dest='types',
+                            help='Name of RelationshipType to export, default is all')
+
+    def handle(self, *args, **options):
+        # Snapshots of other types are stale, they will be rebuilt when they are used
+        version = bump_version()
+        rel_types = RelationshipType.objects.all()
+        if options['types']:
+            rel_types = rel_types.filter(name__in=options['types'])
+        for rel_type in rel_types:
+            self.stdout.write('Exported %s to %s' % (rel_type.name, export(rel_type, version)))
@@ -5,6 +5,8 @@ from django.core.exceptions import FieldDoesNotExist
 from django.core.management.base import BaseCommand, CommandError
 
 from bman.models import *
+from bman.models.registry import relationship_types, catalogs
+from bman.models.relationship import EXISTS_ERROR
 
 # Read csv file and create model instances
 
@@ -195,12 +197,17 @@ def _csv_to_person(csv_row_dict):
         person = Person.objects.create(**data)
     return person
 
-def _apply_organisation_relationship(orgs):
-    if len(orgs) < 2:
-        return
-    rel_type = RelationshipType.objects.get(name='Organisation')
-    for i in range(len(orgs)-1):
-        Relationship.objects.get_or_create(relationshiptype=rel_type, tail_id=orgs[i].pk, head_id=orgs[i+1].pk)
+def _organisation_edges(orgs):
+    """Edges between organisations in hierarchical order, created by _create_edges"""
+    rel_type = relationship_types.get('Organisation')
+    return [dict(relationshiptype=rel_type, tail_id=orgs[i].pk, head_id=orgs[i+1].pk) for i in range(len(orgs)-1)]
+
+def _create_edges(edges):
+    """Create edges in bulk, existing ones are ignored as get_or_create does"""
+    _, rejected = Relationship.objects.bulk_link(edges)
+    for edge, reason in rejected:
+        if reason != EXISTS_ERROR:
+            print('Cannot create relationship from %(tail_id)s to %(head_id)s: ' % edge + reason)
 
 #Create organisations by there names: columns listed in ORGANISATION_COLS
 #Order is important
@@ -208,11 +215,10 @@ def _csv_to_organisations(csv_row_dict):
     orgs = []
     for col in ORGANISATION_COLS:
         if csv_row_dict[col].strip():
-            org, _ = Organisation.objects.get_or_create(name=csv_row_dict[col])
+            org = Organisation.objects.resolve(csv_row_dict[col])
             # These are in hierachical relationship, so, they cannot appear twice
             if org not in orgs:
                 orgs.append(org)
-    _apply_organisation_relationship(orgs)
     if len(orgs) == 0:
         raise FieldDoesNotExist("No organisation found in all accepted formats")
     return orgs
@@ -226,7 +232,7 @@ def _csv_to_role(csv_row_dict, person, org):
 
     try:
         role_name = get_normalised_role(role_name)
-        rel_type = RelationshipType.objects.get(name=role_name)
+        rel_type = relationship_types.get(role_name)
         role, _ = Role.objects.get_or_create(person=person, organisation=org, relationshiptype=rel_type, **data)
         return role
     except KeyError:
@@ -242,7 +248,11 @@ def _csv_to_role(csv_row_dict, person, org):
 def _csv_to_account(csv_row_dict, role):
     data = get_model_data(csv_row_dict, ACCOUNT)
     if data['username']:
-        data['billing_org'], _ = Organisation.objects.get_or_create(name=data['billing_org'])
+        if data['billing_org']:
+            data['billing_org'] = Organisation.objects.resolve(data['billing_org'])
+        else:
+            # A blank cell is billed to the organisation without a name, as before names were resolved
+            data['billing_org'], _ = Organisation.objects.get_or_create(name='')
         account, _ = Account.objects.get_or_create(role=role, **data)
         return account
     else:
@@ -252,12 +262,13 @@ import re
 FIRST_NAME = re.compile(r"^[A-Z][ \'\w-]+$")
 LAST_NAME = re.compile(r"^[A-Za-z][ \'\w-]+$")
 
-SUPERVISOR_TYPE = RelationshipType.objects.get(name='Employment')
+SUPERVISOR_TYPE = 'Employment'
 def _csv_to_supervisor(csv_row_dict, student):
+    """Get the edge from supervisor to student, created by _create_edges"""
     #Supervisor column is full of free text, so be picky
     supervisor_cell = csv_row_dict['Supervisor']
     if not supervisor_cell:
-        return
+        return None
 
     try:
         first_name, last_name = supervisor_cell.split(' ')[-2:]
@@ -266,9 +277,9 @@ def _csv_to_supervisor(csv_row_dict, student):
             # check Employment role?
             supervisor, _ = Person.objects.get_or_create(first_name=first_name, last_name=last_name)
             try:
-                employee = supervisor.role_set.get(relationshiptype=SUPERVISOR_TYPE)
-                rel_type = RelationshipType.objects.get(name='Supervision')
-                Relationship.objects.get_or_create(relationshiptype=rel_type, tail_id=employee.pk, head_id=student.pk)
+                employee = supervisor.role_set.get(relationshiptype=relationship_types.get(SUPERVISOR_TYPE))
+                rel_type = relationship_types.get('Supervision')
+                return dict(relationshiptype=rel_type, tail_id=employee.pk, head_id=student.pk)
             except Exception as e:
                 raise ValueError('Cannot find a suitable supervisor in empolyment relationship with an organisation. Error: %s' % str(e))
         else:
@@ -303,12 +314,14 @@ def _load(fn):
         for row in spamreader:
             rows.append(row)
 
-      access_services = {'HPC': Catalog.objects.get(name='HPC'),
-                          'STORAGE': Catalog.objects.get(name='Storage')}
+      access_services = {'HPC': catalogs.get('HPC'),
+                          'STORAGE': catalogs.get('Storage')}
       cache = []
+      edges = []
       for row in rows:
         try:
             orgs = _csv_to_organisations(row)
+            edges.extend(_organisation_edges(orgs))
             person = _csv_to_person(row)
             role = _csv_to_role(row, person, orgs[-1])
             _csv_to_services(row, role, access_services)
@@ -318,13 +331,19 @@ def _load(fn):
             print('Cannot create model: %s' % e)
             print('Insightly_ID=%(Insightly ID)s, email=%(Email Address)s, name=%(Full Name)s, username=%(Username)s\n' % row)
 
+      _create_edges(edges)
+
       #After all persons have been loaded, try to hook up with supervisor
+      edges = []
       for row, role in cache:
         try:
-            _csv_to_supervisor(row, role)
+            edge = _csv_to_supervisor(row, role)
+            if edge:
+                edges.append(edge)
         except Exception as e:
             print('Fail to establish supervison relationship: %s' % e)
             print('Insightly_ID=%(Insightly ID)s, email=%(Email Address)s, name=%(Full Name)s, username=%(Username)s\n' % row)
+      _create_edges(edges)
 
 class Command(BaseCommand):
     help = 'Load data from a csv file and put them into the database'
@@ -346,5 +365,7 @@ class Command(BaseCommand):
         if options['models']:
             self.stdout.write(str(options['models']))
 
-        _load(options['file_name'])
+        # Organisation names repeat in rows, each is resolved by one query in this run
+        with Organisation.objects.memoised():
+            _load(options['file_name'])
 
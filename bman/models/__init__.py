@@ -1,14 +1,20 @@
 from .relationship import RelationshipType, Relationship
 from .person import Person, Role, Account
-from .organisation import Organisation
+from .organisation import Organisation, OrganisationClosure
 from .service import Catalog, AccessService, RDS, Nectar
+from .ownership import ServiceOwnership
+from .search import SearchTerm
+from . import graph  # NOQA: connects signal handlers of snapshots
+from . import directory  # NOQA: connects signal handlers of the account directory
+from .registry import relationship_types, catalogs, event_types
 
+from django.apps import apps
 from django.db import models
 
 app_name = __name__.split('.')[0]
 
-__all__ = ['Event', 'EventType', 'Organisation', 'Person', 'Role', 'Account',
-           'RelationshipType', 'Relationship', 'AccessService', 'Catalog', 'RDS', 'Nectar']
+__all__ = ['Event', 'EventType', 'Organisation', 'OrganisationClosure', 'Person', 'Role', 'Account',
+           'RelationshipType', 'Relationship', 'AccessService', 'Catalog', 'RDS', 'Nectar', 'ServiceOwnership', 'SearchTerm']
 
 #Will be managed by code only. Load from fixture
 class EventType(models.Model):
@@ -25,6 +31,11 @@ class EventType(models.Model):
     def __str__(self):
         return self.full_name if self.full_name else self.name
 
+
+relationship_types.bind(RelationshipType)
+catalogs.bind(Catalog)
+event_types.bind(EventType)
+
 class Event(models.Model):
     """Event happend to entities"""
     type = models.ForeignKey(EventType)
@@ -59,8 +70,9 @@ class Event(models.Model):
     #~ )
 
     def __str__(self):
-        entity = apps.get_model(app_name, self.type.entity).objects.get(pk=self.entity_id)
-        return "%s: %s %s" % (self.date, self.type, entity)
+        event_type = event_types.get_by_pk(self.type_id)
+        entity = apps.get_model(app_name, event_type.entity).objects.get(pk=self.entity_id)
+        return "%s: %s %s" % (self.date, event_type, entity)
 
 ##This section is a to-do thing
 #from django.db.models.signals import post_save
@@ -0,0 +1,72 @@
+"""Directory of all account usernames for systems which resolve them to people
+
+The directory is built from one join and kept in the Django cache as JSON together with
+a version token and a hash of the JSON. The token is replaced whenever an Account, Role,
+Person or Organisation is saved or deleted, and the hash is the ETag of the API so polling
+clients get 304 until something changes. With a cache backend shared by processes, e.g.
+memcached set in settings.CACHES, changes are seen at once. Otherwise each process
+rebuilds its directory after settings.BMAN_DIRECTORY_TIMEOUT seconds (default is 60),
+so changes by other processes, e.g. `manage.py loadcsv`, are seen by then.
+"""
+import json
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+
+from .person import Person, Role, Account
+from .organisation import Organisation
+from .utils import get_cache_version, bump_cache_version
+
+VERSION_KEY = 'bman.directory.version'
+DIRECTORY_KEY = 'bman.directory'
+
+
+def get_version():
+    """Get the current version token, a new one when the cache has lost it"""
+    return get_cache_version(VERSION_KEY)
+
+
+def bump_version():
+    bump_cache_version(VERSION_KEY)
+
+
+def build_directory():
+    """Get {username: {role_id, fullname, organisation, billing_organisation, email}} of all accounts"""
+    rows = Account.objects.order_by().values_list(
+        'username', 'role_id', 'role__person__first_name', 'role__person__last_name',
+        'role__organisation__name', 'billing_org__name', 'role__email')
+    directory = {}
+    for username, role_id, first_name, last_name, organisation, billing_organisation, email in rows:
+        directory[username] = dict(
+            role_id=role_id,
+            # Same as Person.full_name
+            fullname='%s %s' % (first_name, last_name),
+            organisation=organisation,
+            billing_organisation=billing_organisation,
+            email=email)
+    return directory
+
+
+def get_directory():
+    """Get (ETag, JSON string of the directory), it is rebuilt when the version has changed or it has expired"""
+    version = get_version()
+    cached = cache.get(DIRECTORY_KEY)
+    if cached is not None and cached[0] == version:
+        return cached[1:]
+    # Read version before the query: a change made during it leaves the result stale for one call
+    content = json.dumps(build_directory(), sort_keys=True)
+    # Same content has the same ETag in every process and after rebuilds
+    etag = hashlib.md5(content.encode('utf-8')).hexdigest()
+    cache.set(DIRECTORY_KEY, (version, etag, content), getattr(settings, 'BMAN_DIRECTORY_TIMEOUT', 60))
+    return etag, content
+
+
+def _directory_changed(sender, **kwargs):
+    bump_version()
+
+
+for model in (Account, Role, Person, Organisation):
+    post_save.connect(_directory_changed, sender=model)
+    post_delete.connect(_directory_changed, sender=model)
@@ -0,0 +1,273 @@
+"""Read-only snapshots of Relationships for lookups without database queries
+
+For every RelationshipType, edges are exported into a file of unsigned 32-bit integers
+in compressed sparse row (CSR) format:
+
+    [MAGIC, version, n (nodes), m (edges), last_pk, checksum,
+     node_ids[n] (sorted),
+     out_offsets[n + 1], out_neighbours[m],   # tail to head
+     in_offsets[n + 1], in_neighbours[m]]     # head to tail
+
+Neighbours are positions in node_ids. Processes, e.g. gunicorn workers, memory-map the
+same file so the pages are shared. The directory is settings.BMAN_GRAPH_DIR.
+
+A version file in the same directory is bumped whenever a Relationship is saved or
+deleted, and by `python manage.py exportgraph`. Signals are sent before the transaction
+commits, so another process may export old edges under the new version. A snapshot also
+keeps a stamp of its edges: their count, the last pk and a checksum of their ends, which
+get_graph compares with the database by one query and rebuilds the snapshot when they
+differ. Relationships changed without signals, e.g. by update, are found by the stamp too
+unless the sums of their ends stay the same, exportgraph rebuilds them.
+"""
+import os
+import mmap
+import fcntl
+import tempfile
+from array import array
+from bisect import bisect_left
+
+import logging
+
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .relationship import RelationshipType, Relationship, relationships_created
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 0x32525343  # CSR2
+HEADER_SIZE = 6
+TYPE_CODE = 'I'
+# Versions stay in range of the 32-bit header
+VERSION_MODULO = 0xFFFFFFFF
+
+
+def get_graph_dir():
+    graph_dir = getattr(settings, 'BMAN_GRAPH_DIR', os.path.join(tempfile.gettempdir(), 'bman_graph'))
+    os.makedirs(graph_dir, exist_ok=True)
+    return graph_dir
+
+
+def _version_path():
+    return os.path.join(get_graph_dir(), 'version')
+
+
+def get_version():
+    """Get current version of Relationships, 0 if it has never been bumped"""
+    try:
+        with open(_version_path(), 'r') as f:
+            return int(f.read() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def bump_version():
+    """Increase the version so all snapshots become stale"""
+    with open(_version_path(), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            version = (int(f.read() or 0) + 1) % VERSION_MODULO
+        except ValueError:
+            version = 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(version))
+    return version
+
+
+def snapshot_path(rel_type_name):
+    return os.path.join(get_graph_dir(), '%s.csr' % rel_type_name)
+
+
+def _csr(n, pairs):
+    """Build offsets and neighbours arrays from (source, destination) positions"""
+    offsets = array(TYPE_CODE, [0]) * (n + 1)
+    for source, _ in pairs:
+        offsets[source + 1] += 1
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    neighbours = array(TYPE_CODE, [0]) * len(pairs)
+    filled = offsets[:-1]
+    # pairs are sorted by their creation, keep that order in neighbours
+    for source, destination in pairs:
+        neighbours[filled[source]] = destination
+        filled[source] += 1
+    return offsets, neighbours
+
+
+def _stamp(count, last_pk, tail_sum, head_sum):
+    """Get (m, last_pk, checksum) of edges in range of the 32-bit header"""
+    return count, last_pk or 0, ((tail_sum or 0) * 2 + (head_sum or 0)) % VERSION_MODULO
+
+
+def get_stamp(rel_type):
+    """Get the stamp of edges of a RelationshipType in the database by one query"""
+    edges = Relationship.objects.filter(relationshiptype=rel_type).order_by().aggregate(
+        count=Count('pk'), last_pk=Max('pk'), tail_sum=Sum('tail_id'), head_sum=Sum('head_id'))
+    return _stamp(**edges)
+
+
+def export(rel_type, version=None):
+    """Write a snapshot of a RelationshipType, returns the path of the file
+
+    rel_type can either be the name string of RelationshipType or an instance.
+    The file is replaced atomically, processes which have mapped the old one can
+    still read it.
+    """
+    rel_type = Relationship._ensure_type(rel_type)
+    if version is None:
+        version = get_version()
+    # Sorted in memory, ORDER BY pk would not use the index of type
+    edges = sorted(Relationship.objects.filter(relationshiptype=rel_type)
+                   .order_by().values_list('pk', 'tail_id', 'head_id'))
+    stamp = _stamp(len(edges), edges[-1][0] if edges else 0,
+                   sum(tail for _, tail, _ in edges), sum(head for _, _, head in edges))
+    edges = [(tail, head) for _, tail, head in edges]
+    node_ids = sorted(set(tail for tail, _ in edges) | set(head for _, head in edges))
+    position = {node_id: i for i, node_id in enumerate(node_ids)}
+    n = len(node_ids)
+
+    data = array(TYPE_CODE, [MAGIC, version, n])
+    data.extend(stamp)
+    data.extend(node_ids)
+    for pairs in ([(position[tail], position[head]) for tail, head in edges],
+                  [(position[head], position[tail]) for tail, head in edges]):
+        offsets, neighbours = _csr(n, pairs)
+        data.extend(offsets)
+        data.extend(neighbours)
+
+    path = snapshot_path(rel_type.name)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        data.tofile(f)
+    os.replace(temp_path, path)
+    return path
+
+
+class RelationshipGraph(object):
+    """Memory-mapped snapshot of a RelationshipType, see the module docstring for the format"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        values = memoryview(self._map).cast(TYPE_CODE)
+        if len(values) < HEADER_SIZE or values[0] != MAGIC:
+            raise ValueError('%s is not a relationship snapshot' % path)
+        self.version, n, m = values[1], values[2], values[3]
+        self.stamp = tuple(values[3:HEADER_SIZE])
+
+        start = HEADER_SIZE
+        self.node_ids = values[start:start + n]
+        start += n
+        self._out_offsets = values[start:start + n + 1]
+        start += n + 1
+        self._out_neighbours = values[start:start + m]
+        start += m
+        self._in_offsets = values[start:start + n + 1]
+        start += n + 1
+        self._in_neighbours = values[start:start + m]
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def _position(self, node_id):
+        i = bisect_left(self.node_ids, node_id)
+        if i < len(self.node_ids) and self.node_ids[i] == node_id:
+            return i
+        return None
+
+    def _neighbours(self, position, offsets, neighbours):
+        return neighbours[offsets[position]:offsets[position + 1]]
+
+    def children(self, node_id):
+        """Get head ids of edges which node_id is the tail of"""
+        i = self._position(node_id)
+        if i is None:
+            return []
+        return [self.node_ids[j] for j in self._neighbours(i, self._out_offsets, self._out_neighbours)]
+
+    def parents(self, node_id):
+        """Get tail ids of edges which node_id is the head of"""
+        i = self._position(node_id)
+        if i is None:
+            return []
+        return [self.node_ids[j] for j in self._neighbours(i, self._in_offsets, self._in_neighbours)]
+
+    def ancestors(self, node_id, max_depth=None):
+        """Get ids by following the first parent from node_id to the top: [parent_id, grand_id, ...]
+
+        The path stops after max_depth parents, or before an id which is already in it.
+        """
+        i = self._position(node_id)
+        path, seen = [], {i}
+        while i is not None and (max_depth is None or len(path) < max_depth):
+            parents = self._neighbours(i, self._in_offsets, self._in_neighbours)
+            if len(parents) == 0:
+                break
+            if parents[0] in seen:
+                logger.warning('Cycle of relationships found at %s from %s', self.node_ids[parents[0]], node_id)
+                break
+            i = parents[0]
+            seen.add(i)
+            path.append(self.node_ids[i])
+        return path
+
+    def root(self, node_id):
+        """Get the top id of node_id, node_id itself when it has no parent"""
+        path = self.ancestors(node_id)
+        return path[-1] if path else node_id
+
+    def subtree(self, node_id):
+        """Get ids of all descendants of node_id in depth-first order"""
+        i = self._position(node_id)
+        if i is None:
+            return []
+        flattened, seen = [], {i}
+        stack = list(reversed(self._neighbours(i, self._out_offsets, self._out_neighbours)))
+        while stack:
+            j = stack.pop()
+            if j in seen:
+                continue
+            seen.add(j)
+            flattened.append(self.node_ids[j])
+            stack.extend(reversed(self._neighbours(j, self._out_offsets, self._out_neighbours)))
+        return flattened
+
+
+_graphs = {}
+
+
+def get_graph(rel_type):
+    """Get the snapshot of a RelationshipType by its name or instance
+
+    The version file and the stamp of edges in the database, one query, are read when
+    the mapped snapshot is current. A stale or missing snapshot is exported first.
+    """
+    rel_type = Relationship._ensure_type(rel_type)
+    version, stamp = get_version(), get_stamp(rel_type)
+    graph = _graphs.get(rel_type.name)
+    if graph is None or (graph.version, graph.stamp) != (version, stamp):
+        try:
+            graph = RelationshipGraph(snapshot_path(rel_type.name))
+        except (IOError, ValueError):
+            graph = None
+        if graph is None or (graph.version, graph.stamp) != (version, stamp):
+            graph = RelationshipGraph(export(rel_type, version))
+        _graphs[rel_type.name] = graph
+    return graph
+
+
+@receiver(post_save, sender=Relationship)
+@receiver(post_delete, sender=Relationship)
+@receiver(relationships_created, sender=Relationship)
+def _relationship_changed(sender, **kwargs):
+    bump_version()
+
+
+@receiver(post_save, sender=RelationshipType)
+@receiver(post_delete, sender=RelationshipType)
+def _relationshiptype_changed(sender, **kwargs):
+    bump_version()
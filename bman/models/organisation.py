@@ -1,39 +1,46 @@
-from django.db import models
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.models import Q, Count, Sum
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .relationship import RelationshipType, Relationship, relationships_created
+from .registry import relationship_types
+from .utils import traverse, get_cache_version, bump_cache_version, is_true
+
+logger = logging.getLogger(__name__)
+
+# Name of RelationshipType which builds the hierarchy of organisations
+ORGANISATION_RELATIONSHIP = 'Organisation'
+# Hierarchies are a few levels deep, longer paths only come from corrupted data
+MAX_DEPTH = 32
+NORMALISED_NAME_LENGTH = 255
+# Version of cached billing organisations, bumped when accounts change them or organisations change
+BILLING_VERSION_KEY = 'bman.organisation.billing.version'
 
 
 def get_parent_ids_of(bottom_id, rtype=None):
     """Get parent entity id(tail id)s of a Relationship type of a model instance with bottom_id
 
-    In such tree structure, it gets tail_id of such RelationshipType recursively.
+    In such tree structure, it gets tail_id of such RelationshipType level by level.
     The return is a list in the order of bottom_id to the top:
     [parent_id, grand_id, great_grand_id, ...]
 
-    rtype can be a string or a RelationshipType instance. By default, it finds child
+    rtype can be a string or a RelationshipType instance. By default, it finds parent
     Organisations of an Organisation defined by RelationshipType.name='Organisation'.
     """
-    from .relationship import RelationshipType, Relationship
-    if rtype is None:
-        rtype = RelationshipType.objects.get(name='Organisation')
-    elif isinstance(rtype, str):
-        rtype = RelationshipType.objects.get(name=rtype)
-
-    # With tree structure, every entity has only one parent
-    parent_ids = []
-
-    parents = Relationship.objects.filter(relationshiptype=rtype, head_id=bottom_id)
-    if parents:
-        for parent in parents:
-            parent_ids.append(parent.tail_id)
-            level_up = get_parent_ids_of(parent.tail_id, rtype)
-            if level_up:
-                parent_ids.extend(level_up)
-
-    return parent_ids
+    rtype = Relationship._ensure_type(rtype or ORGANISATION_RELATIONSHIP)
+    hops = traverse((rtype.entity_head, [bottom_id]), [rtype], 'backward', depth=None, hydrate=False)
+    return [hop.target_id for hop in hops]
 
 
 def get_child_ids_of(top_id, rtype=None):
     """Get ids of entities of Relationships of a model instance with top_id is the
-       tail_id of such RelationshipType recursively. The return is a dictionary of
+       tail_id of such RelationshipType level by level. The return is a dictionary of
        recursive fashion like this:
     {
       "68": {},
@@ -44,18 +51,68 @@ def get_child_ids_of(top_id, rtype=None):
     }
     rtype can be a string or a RelationshipType instance. By default, it finds child
     Organisations of an Organisation defined by RelationshipType.name='Organisation'.
+    An entity with more than one parent is listed under each of them. An edge back to
+    an entity above, which only corrupted data has, is left out.
+    """
+    rtype = Relationship._ensure_type(rtype or ORGANISATION_RELATIONSHIP)
+    hops = traverse((rtype.entity_tail, [top_id]), [rtype], 'forward', depth=None, hydrate=False, per_source=True)
+    nodes = {}
+    for hop in hops:
+        source, target = str(hop.source_id), str(hop.target_id)
+        if target in nodes and _is_below(source, nodes[target]):
+            continue
+        nodes.setdefault(source, {})[target] = nodes.setdefault(target, {})
+    return nodes.get(str(top_id), {})
+
+
+def _is_below(node_id, ids):
+    """Check if node_id is in a recursive dictionary of ids"""
+    stack = [ids]
+    while stack:
+        ids = stack.pop()
+        if node_id in ids:
+            return True
+        stack.extend(ids.values())
+    return False
+
+def get_ancestor_paths_of(bottom_ids, rtype=None, max_depth=MAX_DEPTH):
+    """Get parent ids of many entities at once, a batch version of get_parent_ids_of
+
+    Returns a dictionary of bottom id to a list in the order of bottom_id to the top:
+    {bottom_id: [parent_id, grand_id, ...]}. When an entity has more than one parent, the
+    first created is followed.
+
+    Paths are read from the snapshot of the type, see graph.get_graph, so there is one
+    query for any number of entities and depths when it is current. A path stops after
+    max_depth levels, or before an id which is already in it, so corrupted data cannot
+    make it run forever.
     """
-    from .relationship import RelationshipType, Relationship
-    if rtype is None:
-        rtype = RelationshipType.objects.get(name='Organisation')
-    elif isinstance(rtype, str):
-        rtype = RelationshipType.objects.get(name=rtype)
-
-    children = Relationship.objects.filter(relationshiptype=rtype, tail_id=top_id)
-    child_ids = {}
-    for child in children:
-        child_ids[str(child.head_id)] = get_child_ids_of(child.head_id, rtype)
-    return child_ids
+    from .graph import get_graph
+    bottom_ids = set(bottom_ids)
+    try:
+        rtype = Relationship._ensure_type(rtype or ORGANISATION_RELATIONSHIP)
+    except RelationshipType.DoesNotExist:
+        # No relationships of a type which is not defined
+        return {bottom_id: [] for bottom_id in bottom_ids}
+    graph = get_graph(rtype)
+    return {bottom_id: graph.ancestors(bottom_id, max_depth) for bottom_id in bottom_ids}
+
+
+def get_root_ids_of(bottom_ids, rtype=None, max_depth=MAX_DEPTH):
+    """Get the top id of many entities at once: {bottom_id: root_id}, see get_ancestor_paths_of
+
+    An entity without a parent is its own root.
+    """
+    paths = get_ancestor_paths_of(bottom_ids, rtype, max_depth)
+    return {bottom_id: path[-1] if path else bottom_id for bottom_id, path in paths.items()}
+
+
+def _to_ids(ids):
+    """Get a list of int ids from a list or a string separated by , or ; from query strings"""
+    if isinstance(ids, str):
+        ids = [part for part in ids.replace(';', ',').split(',') if part.strip()]
+    return [int(i) for i in ids]
+
 
 def flat_ids(ids, flattened):
     """Flat ids in a recusive dictionary and return a list
@@ -100,8 +157,281 @@ def get_tree_leaves(ids, query_model):
         print(e)
     return tree
 
+
+def build_tree(edges, names, top_id):
+    """Assemble the same dictionary as get_tree_leaves from edges and names in memory
+
+    edges is a list of (tail_id, head_id) in the order children should appear and
+    names is a dictionary of id to an object which has name attribute, e.g. the
+    result of in_bulk. Nodes without names are skipped.
+    """
+    children = {}
+    for tail, head in edges:
+        children.setdefault(tail, []).append(head)
+
+    def _leaves(node_id, path):
+        tree = {}
+        for child_id in children.get(node_id, []):
+            # Stop at cycles of corrupted data
+            if child_id not in names or child_id in path:
+                continue
+            tree[str(child_id)] = {'name': names[child_id].name}
+            if child_id in children:
+                leaves = _leaves(child_id, path | {child_id})
+                if leaves:
+                    tree[str(child_id)]['children'] = leaves
+        return tree
+
+    return _leaves(top_id, {top_id})
+
+
+class OrganisationClosure(models.Model):
+    """Ancestor and descendant pairs of Organisations in the hierarchy
+
+    There is a row for every path between two organisations linked by Relationships
+    of RelationshipType.name='Organisation'. depth is the number of edges of the path:
+    a parent and its child has depth 1. Rows are kept in sync by signal handlers of
+    Relationship. Relationships created or deleted without signals, e.g. by
+    bulk_create, loaddata or raw SQL, need `python manage.py buildclosure`.
+    """
+    ancestor_id = models.PositiveIntegerField()
+    descendant_id = models.PositiveIntegerField()
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('ancestor_id', 'descendant_id')
+        index_together = [('descendant_id', 'depth')]
+
+    def __str__(self):
+        return "%d is %d level(s) above %d" % (self.ancestor_id, self.depth, self.descendant_id)
+
+    @classmethod
+    def _edges(cls):
+        try:
+            return Relationship.objects.filter(
+                relationshiptype=relationship_types.get(ORGANISATION_RELATIONSHIP)).order_by()
+        except RelationshipType.DoesNotExist:
+            return Relationship.objects.none()
+
+    @classmethod
+    def link(cls, tail_id, head_id):
+        """Add paths created by a new edge from tail_id to head_id"""
+        ancestors = [(tail_id, 0)]
+        ancestors.extend(cls.objects.filter(descendant_id=tail_id).values_list('ancestor_id', 'depth'))
+        descendants = [(head_id, 0)]
+        descendants.extend(cls.objects.filter(ancestor_id=head_id).values_list('descendant_id', 'depth'))
+
+        existing = set(cls.objects.filter(
+            ancestor_id__in=[a for a, _ in ancestors],
+            descendant_id__in=[d for d, _ in descendants]).values_list('ancestor_id', 'descendant_id'))
+        pairs = []
+        for ancestor, up in ancestors:
+            for descendant, down in descendants:
+                # a cycle in corrupted data should not make an organisation its own ancestor
+                if ancestor != descendant and (ancestor, descendant) not in existing:
+                    pairs.append(cls(ancestor_id=ancestor, descendant_id=descendant, depth=up + down + 1))
+        cls.objects.bulk_create(pairs)
+        Organisation.objects.filter(pk=tail_id).update(is_parent=True)
+        Organisation.objects.filter(pk=head_id).update(is_child=True)
+
+    @classmethod
+    def unlink(cls, tail_id, head_id):
+        """Remove paths which went through a deleted edge from tail_id to head_id"""
+        ancestors = [tail_id]
+        ancestors.extend(cls.objects.filter(descendant_id=tail_id).values_list('ancestor_id', flat=True))
+        descendants = [head_id]
+        descendants.extend(cls.objects.filter(ancestor_id=head_id).values_list('descendant_id', flat=True))
+        cls.objects.filter(ancestor_id__in=ancestors, descendant_id__in=descendants).delete()
+        edges = cls._edges()
+        Organisation.objects.filter(pk=tail_id).update(is_parent=edges.filter(tail_id=tail_id).exists())
+        Organisation.objects.filter(pk=head_id).update(is_child=edges.filter(head_id=head_id).exists())
+
+        # Without tail constraint, some removed paths may still exist through other
+        # parents. Adding back the remaining edges entering the subtree restores them.
+        for tail, head in cls._edges().filter(head_id__in=descendants) \
+                .exclude(tail_id__in=descendants).values_list('tail_id', 'head_id'):
+            cls.link(tail, head)
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the whole table from existing Relationships"""
+        children = {}
+        for tail, head in cls._edges().values_list('tail_id', 'head_id'):
+            children.setdefault(tail, []).append(head)
+
+        pairs = []
+        for top in children:
+            # breadth first, so the first visit of a node is by its shortest path
+            visited = {top}
+            level, depth = children[top], 1
+            while level:
+                next_level = []
+                for node in level:
+                    if node in visited:
+                        continue
+                    visited.add(node)
+                    pairs.append(cls(ancestor_id=top, descendant_id=node, depth=depth))
+                    next_level.extend(children.get(node, []))
+                level, depth = next_level, depth + 1
+
+        cls.objects.all().delete()
+        cls.objects.bulk_create(pairs)
+
+        edges = cls._edges()
+        Organisation.objects.update(is_parent=False, is_child=False)
+        Organisation.objects.filter(pk__in=edges.values('tail_id')).update(is_parent=True)
+        Organisation.objects.filter(pk__in=edges.values('head_id')).update(is_child=True)
+        return len(pairs)
+
+    @classmethod
+    def get_roots(cls, descendant_ids=None):
+        """Get {descendant_id: root_id} in one query, of all organisations with ancestors when
+           descendant_ids is None. Like Organisation.get_root_id, the farthest ancestor is the
+           root. Organisations without ancestors are not included, they are their own roots.
+        """
+        pairs = cls.objects.order_by('depth')
+        if descendant_ids is not None:
+            pairs = pairs.filter(descendant_id__in=descendant_ids)
+        # Farthest ones come last and win
+        return dict(pairs.values_list('descendant_id', 'ancestor_id'))
+
+
+def _is_organisation_edge(rel_type_id):
+    return relationship_types.get_by_pk(rel_type_id).name == ORGANISATION_RELATIONSHIP
+
+
+def changed_organisation_edges(instance, created):
+    """Get ([(tail_id, head_id)] removed, [(tail_id, head_id)] added) of the hierarchy by a save
+       of a Relationship, None when what it was before is unknown, e.g. it was not read from
+       the database. Relationship.save keeps what was loaded until all receivers have run.
+    """
+    edge = (instance.relationshiptype_id, instance.tail_id, instance.head_id)
+    added = [edge[1:]] if _is_organisation_edge(edge[0]) else []
+    if created:
+        return [], added
+    loaded = getattr(instance, '_loaded_edge', None)
+    if loaded is None or None in loaded:
+        return None
+    if loaded == edge:
+        return [], []
+    # An edit may move an edge, or change its type from or to Organisation
+    return [loaded[1:]] if _is_organisation_edge(loaded[0]) else [], added
+
+
+@receiver(post_save, sender=Relationship)
+def _link_organisations(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    changes = changed_organisation_edges(instance, created)
+    if changes is None:
+        OrganisationClosure.rebuild()
+        return
+    removed, added = changes
+    for tail_id, head_id in removed:
+        OrganisationClosure.unlink(tail_id, head_id)
+    for tail_id, head_id in added:
+        OrganisationClosure.link(tail_id, head_id)
+
+
+@receiver(relationships_created, sender=Relationship)
+def _link_organisations_in_bulk(sender, relationships, **kwargs):
+    # Many edges are cheaper to be rebuilt in a constant number of queries than linked one by one
+    if any(relationship_types.get_by_pk(rel.relationshiptype_id).name == ORGANISATION_RELATIONSHIP
+           for rel in relationships):
+        OrganisationClosure.rebuild()
+
+
+@receiver(post_delete, sender=Relationship)
+def _unlink_organisations(sender, instance, **kwargs):
+    if relationship_types.get_by_pk(instance.relationshiptype_id).name == ORGANISATION_RELATIONSHIP:
+        OrganisationClosure.unlink(instance.tail_id, instance.head_id)
+
+
+def normalise_name(name):
+    """Fold case and whitespace of an organisation name: ' University  of\tAdelaide' -> 'university of adelaide'"""
+    return ' '.join((name or '').split()).casefold()[:NORMALISED_NAME_LENGTH]
+
+
+class OrganisationManager(models.Manager):
+    """Manager of Organisation which resolves free-text names to organisations
+
+       Resolved names are memoised in a thread while it runs inside memoised(), see resolve.
+    """
+    # {normalised name: Organisation} of the thread, only while memoised() is entered
+    _local = threading.local()
+
+    @contextmanager
+    def memoised(self):
+        """Memoise resolved names in this thread until the block exits, e.g. for a run of loadcsv"""
+        outer = getattr(self._local, 'memo', None)
+        if outer is None:
+            self._local.memo = {}
+            self._local.depth = self._atomic_depth()
+        try:
+            yield
+        finally:
+            if outer is None:
+                self._local.memo = None
+
+    @staticmethod
+    def _atomic_depth():
+        return connection.in_atomic_block, len(connection.savepoint_ids)
+
+    def clear_memo(self):
+        if getattr(self._local, 'memo', None) is not None:
+            self._local.memo = {}
+
+    def _forget(self, pk):
+        memo = getattr(self._local, 'memo', None) or {}
+        for key in [key for key, org in memo.items() if org.pk == pk]:
+            del memo[key]
+
+    def normalise_names(self):
+        """Set normalised_name of organisations saved without it, returns the number updated"""
+        count = 0
+        for pk, name, normalised in self.order_by().values_list('pk', 'name', 'normalised_name').iterator():
+            if normalised != normalise_name(name):
+                self.filter(pk=pk).update(normalised_name=normalise_name(name))
+                count += 1
+        self.clear_memo()
+        return count
+
+    def resolve(self, name, create=True):
+        """Get the organisation of a name regardless of case and whitespace, None when name is blank
+
+           The lookup is by the indexed normalised_name, the oldest is used when there are
+           duplicates, and a missing one is created with the name stripped unless create is
+           False, in which case DoesNotExist is raised. When another organisation of the name
+           has been committed meanwhile, the created one is deleted and the oldest is used.
+
+           Inside memoised() results are kept until an organisation is saved or deleted in
+           this process, but not within a transaction or savepoint started inside it, which
+           could be rolled back. Instances returned are shared, do not change them.
+        """
+        key = normalise_name(name)
+        if not key:
+            return None
+        memo = getattr(self._local, 'memo', None)
+        if memo is not None and key in memo:
+            return memo[key]
+        org = self.filter(normalised_name=key).order_by('pk').first()
+        if org is None:
+            if not create:
+                raise self.model.DoesNotExist('Organisation %s does not exist' % name)
+            org = self.create(name=' '.join(name.split()))
+            oldest = self.filter(normalised_name=key).order_by('pk').first()
+            if oldest.pk != org.pk:
+                org.delete()
+                org = oldest
+        if memo is not None and self._atomic_depth() == self._local.depth:
+            memo[key] = org
+        return org
+
+
 class Organisation(models.Model):
     name = models.TextField(blank=False)
+    # Set from name before saves, for resolving names without scanning or duplicating
+    normalised_name = models.CharField(max_length=NORMALISED_NAME_LENGTH, db_index=True, editable=False, default='')
     description = models.TextField(blank=True, default='')
     site = models.URLField('URL of website', blank=True, default='')
     #~ #Currently is not used, may be used for performance ?
@@ -109,107 +439,309 @@ class Organisation(models.Model):
     abbreviation = models.CharField(max_length=30, blank=True, default='')
     address = models.TextField(blank=True, default='')
     insightly_id = models.PositiveIntegerField(blank=True, null=True)
+    # Maintained with OrganisationClosure by signal handlers of Relationship
+    is_parent = models.BooleanField(default=False, editable=False, help_text='If it has child organisations')
+    is_child = models.BooleanField(default=False, editable=False, help_text='If it has parent organisations')
+    # Only written by updates of OrganisationClosure, never by save
+    MAINTAINED_FIELDS = ('is_parent', 'is_child')
+    # Numbers of rollup
+    ROLLUP_METRICS = ('roles', 'accounts', 'accessservice', 'rds', 'nectar', 'rds_size')
+
+    objects = OrganisationManager()
+
+    class Meta:
+        index_together = [('is_parent', 'is_child')]
 
     def __str__(self):
         return self.name
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is not None:
+            # Flags follow relationships, they are not written from instances
+            update_fields = [name for name in update_fields if name not in self.MAINTAINED_FIELDS]
+        elif not self._state.adding and not force_insert:
+            self._refresh_maintained_fields(using)
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+
+    def _refresh_maintained_fields(self, using=None):
+        """Read flags again, an instance loaded before a relationship changed has stale ones"""
+        # Deferred fields are not written by save
+        fields = [name for name in self.MAINTAINED_FIELDS if name in self.__dict__]
+        if fields:
+            current = Organisation.objects.db_manager(using).filter(pk=self.pk).values(*fields).first()
+            if current:
+                self.__dict__.update(current)
+
     def get_child_ids(self):
-        """Get ids all child organisations and construct a dictionary in a tree structure"""
-        return get_child_ids_of(self.pk)
+        """Get ids all child organisations and construct a dictionary in a tree structure
+
+        The structure is the same as get_child_ids_of but all edges of the subtree
+        are read in one query through OrganisationClosure.
+        """
+        nodes = {}
+        for tail, head in self._get_subtree_edges():
+            nodes.setdefault(str(tail), {})[str(head)] = nodes.setdefault(str(head), {})
+        return nodes.get(str(self.pk), {})
+
+    def _get_subtree_edges(self):
+        """Get (tail_id, head_id) of all edges under this organisation in one query"""
+        subtree = OrganisationClosure.objects.filter(ancestor_id=self.pk).values('descendant_id')
+        # Sorted in memory: ORDER BY tail_id makes databases read all edges by the (type, tail) index
+        edges = OrganisationClosure._edges().filter(head_id__in=subtree).values_list('pk', 'tail_id', 'head_id')
+        return [(tail, head) for _, tail, head in sorted(edges, key=lambda edge: (edge[1], edge[0]))]
 
     def get_parent_ids(self):
-        """Get current organisation's top organisation"""
-        return get_parent_ids_of(self.pk)
+        """Get ids of parent organisations from the direct parent to the top one"""
+        return list(OrganisationClosure.objects.filter(descendant_id=self.pk)
+                    .order_by('depth').values_list('ancestor_id', flat=True))
 
     def get_root_id(self):
         """Get current organisation's top organisation"""
-        parents = get_parent_ids_of(self.pk)
-        if len(parents):
-            return parents[-1]
+        top = OrganisationClosure.objects.filter(descendant_id=self.pk) \
+            .order_by('-depth').values_list('ancestor_id', flat=True)[:1]
+        if len(top):
+            return top[0]
         else:
             return self.pk
 
+    @classmethod
+    def get_ancestor_paths(cls, ids, max_depth=MAX_DEPTH):
+        """Get parent ids from the direct parent to the top of many organisations: {id: [parent_id, ...]}
+
+           ids is a list or a string of ids separated by , or ;, e.g. ?method=get_ancestor_paths&ids=1;2
+        """
+        return get_ancestor_paths_of(_to_ids(ids), max_depth=int(max_depth))
+
+    @classmethod
+    def get_root_ids(cls, ids, max_depth=MAX_DEPTH):
+        """Get top organisation ids of many organisations: {id: root_id}, see get_ancestor_paths"""
+        return get_root_ids_of(_to_ids(ids), max_depth=int(max_depth))
+
     @property
     def children(self):
-        """Get all children of an organisation. Default is only top.
-           When flatten=True, get all children no matter which level.
-        """
+        """Get direct children of an organisation"""
         return self.get_children(flatten=False)
 
-    def get_children(self, flatten=False):
+    def get_children(self, flatten=False, fields=None):
         """Get all children of an organisation. Default is only top.
-           When flatten=True, get all children no matter which level.
+           When flatten=True, get all children no matter which level in depth-first order.
+
+           All children are loaded by one query. fields is an optional list of field
+           names to load, e.g. ['name'], when full rows are not needed.
         """
         if flatten:
-            ids = flat_ids(self.get_child_ids(), [])
+            ids = [int(org_id) for org_id in flat_ids(self.get_child_ids(), [])]
         else:
-            ids = self.get_child_ids()
-        return [Organisation.objects.get(pk=org_id) for org_id in ids]
+            ids = list(OrganisationClosure._edges().filter(tail_id=self.pk)
+                       .order_by('pk').values_list('head_id', flat=True))
+        query = Organisation.objects.all()
+        if fields:
+            query = query.only(*fields)
+        orgs = query.in_bulk(ids)
+        return [orgs[org_id] for org_id in ids if org_id in orgs]
 
     def has_children(self):
         """Just check if there is any child organisation"""
-        from .relationship import Relationship
-        return len(Relationship.as_end('Organisation', self)) > 0
+        return self.is_parent
 
     def get_tree(self):
-        """Get children Organisations in a tree structure"""
-        return get_tree_leaves(self.get_child_ids(), Organisation.objects.get)
+        """Get children Organisations in a tree structure
 
-    def get_all_services(self):
-        """Get all services this Organisation uses"""
-        accounts = self.get_all_accounts()
+        It has the same structure of get_tree_leaves but only runs two queries:
+        one for all edges of the subtree and one for all names.
+        """
+        edges = self._get_subtree_edges()
+        names = Organisation.objects.only('name').in_bulk([head for _, head in edges])
+        return build_tree(edges, names, self.pk)
+
+    def _get_billed_services(self, name=None, subtree=False):
+        """Get querysets of services billed to this organisation, one per service type
+
+           name limits them to one service type by its class name, case insensitive.
+           With subtree, services billed to descendants of this organisation are included.
+        """
+        from .service import get_service_types, select_services
+        billed = Q(contractor__account__billing_org_id=self.pk)
+        if is_true(subtree):
+            descendants = OrganisationClosure.objects.filter(ancestor_id=self.pk).values('descendant_id')
+            billed |= Q(contractor__account__billing_org_id__in=descendants)
+        service_types = get_service_types()
+        if name:
+            service_types = [service_type for service_type in service_types
+                             if service_type.__name__.lower() == name.lower()]
+        return [select_services(service_type).filter(billed).order_by('pk') for service_type in service_types]
+
+    def get_all_services(self, subtree=False):
+        """Get all services this Organisation uses, one query per service type"""
         services = []
-        for account in accounts:
-            services.extend(account.role.get_all_services())
+        for query in self._get_billed_services(subtree=subtree):
+            services.extend(query)
         return services
 
-    def get_service(self, name=None):
-        """Get all instances of a service this Organisation uses"""
+    def get_service(self, name=None, subtree=False):
+        """Get all instances of a service this Organisation uses
+
+           Returns a list per account which has any, in the order of accounts, of its
+           services in the order they were created. Accounts are read with the services.
+        """
         if not name:
             return []
+        by_account = {}
+        for query in self._get_billed_services(name, subtree):
+            for service in query:
+                by_account.setdefault(service.contractor.account.pk, []).append(service)
+        return [by_account[pk] for pk in sorted(by_account)]
 
-        accounts = self.get_all_accounts()
-        services = []
-        for account in accounts:
-            result = account.role.get_service(name=name)
-            if result and len(result):
-                services.append(result)
-        return services
+    def iter_services(self, name=None, subtree=False):
+        """Yield services like get_all_services, of one type when name is given, without loading all of them
+
+           The API streams the result of this method.
+        """
+        for query in self._get_billed_services(name, subtree):
+            for service in query.iterator():
+                yield service
 
     def get_all_accounts(self):
         """Get all accounts this Organisation pays"""
         from .person import Account
         return Account.objects.all().filter(billing_org__pk=self.pk)
 
-    def get_extended_accounts(self):
-        """Similar to get_all_accounts but for reporting-frontend as a temporary solution"""
+    def get_extended_accounts(self, status=None):
+        """Similar to get_all_accounts but for reporting-frontend as a temporary solution
+
+           Returns {username: {role_id, fullname, organisation, email}} from one query.
+           status filters accounts by Account.STATUS, e.g. ?status=A for active ones.
+        """
         accounts = self.get_all_accounts()
+        if status:
+            accounts = accounts.filter(status=status)
+        rows = accounts.values_list('username', 'role_id', 'role__person__first_name', 'role__person__last_name',
+                                    'role__organisation__name', 'role__email')
         extended = {}
-        for account in accounts:
-            extended[account.username] = dict(
-               role_id= account.role.id,
-               fullname=account.role.person.full_name,
-               organisation=account.role.organisation.name,
-               email=account.role.email)
+        for username, role_id, first_name, last_name, organisation, email in rows:
+            extended[username] = dict(
+               role_id=role_id,
+               # Same as Person.full_name
+               fullname='%s %s' % (first_name, last_name),
+               organisation=organisation,
+               email=email)
         return extended
 
-    def get_all_roles(self):
-        """Get all roles under this organisation"""
-        roles = list(self.role_set.all())
-        ids = flat_ids(self.get_child_ids(), [])
-        for child_id in ids:
-            roles.extend(Organisation.objects.get(pk=child_id).role_set.all())
-        return roles
+    def get_all_roles(self, rel_type=None, start=None, end=None):
+        """Get a list of all roles under this organisation in two queries
 
+           Roles of this organisation come first, then roles of its descendants depth first,
+           the same order as reading role_set of every organisation in the tree.
+
+           rel_type can either be the name string of RelationshipType or an instance.
+           When start or end date is given, only roles active in the period are returned:
+           roles without start_date or end_date are treated as open ended.
+        """
+        from .person import Role
+        subtree = OrganisationClosure.objects.filter(ancestor_id=self.pk).values('descendant_id')
+        roles = Role.objects.filter(Q(organisation_id=self.pk) | Q(organisation_id__in=subtree)) \
+            .select_related('person', 'relationshiptype', 'organisation')
+        if isinstance(rel_type, str):
+            roles = roles.filter(relationshiptype__name=rel_type)
+        elif rel_type is not None:
+            roles = roles.filter(relationshiptype=rel_type)
+        if end:
+            roles = roles.filter(Q(start_date__isnull=True) | Q(start_date__lte=end))
+        if start:
+            roles = roles.filter(Q(end_date__isnull=True) | Q(end_date__gte=start))
+        positions = {org_id: position for position, org_id in
+                     enumerate([self.pk] + [int(org_id) for org_id in flat_ids(self.get_child_ids(), [])])}
+        # Stable sort keeps the ordering of Role in each organisation
+        return sorted(roles, key=lambda role: positions.get(role.organisation_id, len(positions)))
+
+    def get_rollup(self):
+        """Get totals of every organisation in the subtree of this organisation, see rollup"""
+        return Organisation.rollup(self.pk)
+
+    @classmethod
+    def rollup(cls, top_id):
+        """Count roles, active accounts and services and sum RDS sizes for a subtree
+
+           Returns a dictionary of organisation id (str) to a dictionary with name, parent_id,
+           'own': numbers of the organisation itself and 'total': numbers including all of
+           its descendants. Numbers are counted by grouped queries, one per kind, and
+           totals are summed from bottom to top in memory.
+        """
+        top = Organisation.objects.get(pk=top_id)
+        parents, ordered = cls._order_subtree(top)
+        names = dict(Organisation.objects.filter(pk__in=ordered).values_list('pk', 'name'))
+        report = {}
+        for org_id in ordered:
+            report[org_id] = {
+                'name': names.get(org_id, ''),
+                'parent_id': parents.get(org_id),
+                'own': dict.fromkeys(cls.ROLLUP_METRICS, 0)}
+        for org_id, counts in cls._count_in_subtree(top.pk):
+            if org_id in report:
+                report[org_id]['own'].update(counts)
+        cls._sum_up(report, parents, ordered)
+        return {str(org_id): values for org_id, values in report.items()}
+
+    @staticmethod
+    def _order_subtree(top):
+        """Get ({child_id: parent_id}, ids in breadth first order) of a subtree, children come after their parents"""
+        parents, children, ordered = {}, {}, [top.pk]
+        for tail, head in top._get_subtree_edges():
+            children.setdefault(tail, []).append(head)
+        for org_id in ordered:
+            for child_id in children.get(org_id, []):
+                if child_id not in parents and child_id != top.pk:
+                    parents[child_id] = org_id
+                    ordered.append(child_id)
+        return parents, ordered
+
+    @staticmethod
+    def _count_in_subtree(top_id):
+        """Generate (organisation id, {metric: number}) of rollup by one grouped query per kind"""
+        from .person import Role, Account
+        from .service import AccessService, RDS, Nectar
+        subtree = OrganisationClosure.objects.filter(ancestor_id=top_id).values('descendant_id')
+        in_tree = Q(organisation_id=top_id) | Q(organisation_id__in=subtree)
+        contracted = Q(contractor__organisation_id=top_id) | Q(contractor__organisation_id__in=subtree)
+        groups = [
+            ('roles', Role.objects.filter(in_tree), 'organisation_id'),
+            ('accounts', Account.objects.filter(Q(role__organisation_id=top_id) | Q(role__organisation_id__in=subtree),
+                                                status='A'), 'role__organisation_id'),
+            ('accessservice', AccessService.objects.filter(contracted), 'contractor__organisation_id'),
+            ('nectar', Nectar.objects.filter(contracted), 'contractor__organisation_id')
+        ]
+        # Without order_by(), ordering of models, e.g. Role by relationshiptype, is grouped by too
+        for metric, query, field in groups:
+            for org_id, count in query.order_by().values(field).annotate(count=Count('pk')).values_list(field, 'count'):
+                yield org_id, {metric: count}
+        rds = RDS.objects.filter(contracted).order_by().values('contractor__organisation_id') \
+            .annotate(count=Count('pk'), size=Sum('approved_size')) \
+            .values_list('contractor__organisation_id', 'count', 'size')
+        for org_id, count, size in rds:
+            yield org_id, {'rds': count, 'rds_size': size or 0}
+
+    @classmethod
+    def _sum_up(cls, report, parents, ordered):
+        """Set 'total' of every organisation in report from 'own' numbers, from bottom to top"""
+        for org_id in ordered:
+            report[org_id]['total'] = report[org_id]['own'].copy()
+        for org_id in reversed(ordered):
+            parent_id = parents.get(org_id)
+            if parent_id is not None:
+                for metric in cls.ROLLUP_METRICS:
+                    report[parent_id]['total'][metric] += report[org_id]['total'][metric]
 
     @classmethod
     def get_tops(cls, rel_type_name='Organisation'):
         """Get top organisations by querying relationship type
 
            The default relationtype for this query is 'Organisation'
-           which can be replaced if the relationship fixture is not used
+           which can be replaced if the relationship fixture is not used.
+           For 'Organisation', flags maintained with the hierarchy are used.
         """
-        from .relationship import Relationship
+        if rel_type_name == ORGANISATION_RELATIONSHIP:
+            return Organisation.objects.filter(is_parent=True, is_child=False)
+
         ids = Relationship.tail_only(rel_type_name)
         if len(ids):
             return Organisation.objects.filter(id__in=ids)
@@ -218,11 +750,40 @@ class Organisation(models.Model):
 
     @classmethod
     def get_billing_organisations(cls):
-        """Get unique organisations from Account table
+        """Get an evaluated queryset of unique organisations which are billing organisations of accounts, ordered by id
 
-           The default relationtype for this query is 'Organisation'
-           which can be replaced if the relationship fixture is not used
+           They are read by one query with a subquery of Account and cached with their rows
+           until billing organisations of accounts or organisations are changed by save or
+           delete, changes by update need bump_cache_version(BILLING_VERSION_KEY). Reading
+           the cached queryset runs no query, filtering it does.
         """
         from .person import Account
-        biller_ids = [org for org in Account.objects.values_list('billing_org_id', flat=True).distinct()]
-        return Organisation.objects.filter(id__in=biller_ids)
+        key = 'bman.organisation.billing.%s' % get_cache_version(BILLING_VERSION_KEY)
+        billers = cache.get(key)
+        if billers is None:
+            # The subquery is given as a Query, a QuerySet would be run again when pickled
+            billing_org_ids = Account.objects.filter(billing_org__isnull=False).order_by().values('billing_org_id').query
+            billers = Organisation.objects.filter(id__in=billing_org_ids).order_by('pk')
+            # A pickled queryset keeps its rows
+            len(billers)
+            cache.set(key, billers)
+        return billers
+
+
+@receiver(pre_save, sender=Organisation)
+def _normalise_name(sender, instance, **kwargs):
+    # Also runs for loaddata, so fixtures do not need the column
+    instance.normalised_name = normalise_name(instance.name)
+
+
+@receiver(post_save, sender=Organisation)
+def _memo_saved(sender, instance, **kwargs):
+    # The name may have changed, so entries of it are dropped before it is memoised again
+    Organisation.objects._forget(instance.pk)
+    bump_cache_version(BILLING_VERSION_KEY)
+
+
+@receiver(post_delete, sender=Organisation)
+def _memo_deleted(sender, instance, **kwargs):
+    Organisation.objects._forget(instance.pk)
+    bump_cache_version(BILLING_VERSION_KEY)
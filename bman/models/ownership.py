@@ -0,0 +1,179 @@
+"""Denormalized ownership of services for reporting
+
+ServiceOwnership has one row per service with who manages it, who pays for it and which
+organisations it is under, so reports filter and group one table instead of joining
+services, Role, Person, Account and Organisation and walking the hierarchy.
+"""
+from django.db import models
+from django.db.models import Count, F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .relationship import Relationship, relationships_created
+from .registry import relationship_types
+from .person import Role, Account
+from .organisation import ORGANISATION_RELATIONSHIP, OrganisationClosure, changed_organisation_edges
+from .service import get_service_types
+
+
+class ServiceOwnership(models.Model):
+    """Owners of a service, rows are kept in sync by signal handlers of services, Role,
+    Account and Relationship of organisations. Changes made without signals, e.g. by
+    bulk_create, update or loaddata, need `python manage.py buildownership`.
+
+    billing_org_id is the billing organisation of the contractor's account, or the
+    contractor's organisation when there is no account, like BasicService.billing_organisation.
+    """
+    FILTERS = ('service_type', 'status', 'contractor_id', 'person_id', 'organisation_id', 'billing_org_id', 'root_id')
+    GROUPS = ('service_type', 'status', 'person_id', 'organisation_id', 'billing_org_id', 'root_id')
+
+    service_type = models.CharField(max_length=30)
+    service_id = models.PositiveIntegerField()
+    identifier = models.CharField(max_length=200, blank=True, default='')
+    status = models.CharField(max_length=1)
+    contractor_id = models.PositiveIntegerField()
+    person_id = models.PositiveIntegerField()
+    organisation_id = models.PositiveIntegerField()
+    billing_org_id = models.PositiveIntegerField()
+    root_id = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('service_type', 'service_id')
+        index_together = [('billing_org_id', 'service_type'), ('root_id', 'service_type'),
+                          ('organisation_id', 'service_type'), ('person_id', 'service_type'), ('contractor_id', )]
+
+    def __str__(self):
+        return "%s %s is billed to %d" % (self.service_type, self.identifier, self.billing_org_id)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in ('service_type', 'service_id', 'identifier') + self.FILTERS}
+
+    @classmethod
+    def _build(cls, service_type, services):
+        """Get unsaved rows of a queryset of a service type in two queries"""
+        values = list(services.order_by().values_list(
+            'pk', service_type.IDENTIFIER, 'status', 'contractor_id', 'contractor__person_id',
+            'contractor__organisation_id', 'contractor__account__billing_org_id'))
+        roots = OrganisationClosure.get_roots({row[5] for row in values})
+        return [cls(service_type=service_type.__name__, service_id=pk, identifier=str(identifier), status=status,
+                    contractor_id=contractor_id, person_id=person_id, organisation_id=organisation_id,
+                    billing_org_id=billing_org_id or organisation_id,
+                    root_id=roots.get(organisation_id, organisation_id))
+                for pk, identifier, status, contractor_id, person_id, organisation_id, billing_org_id in values]
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the whole table from existing services, returns the number of rows"""
+        rows = []
+        for service_type in get_service_types():
+            rows.extend(cls._build(service_type, service_type.objects.all()))
+        cls.objects.all().delete()
+        cls.objects.bulk_create(rows, batch_size=500)
+        return len(rows)
+
+    @classmethod
+    def refresh(cls, service_type, ids):
+        """Replace rows of services of a type by their ids, rows of deleted ones are removed"""
+        cls.objects.filter(service_type=service_type.__name__, service_id__in=ids).delete()
+        cls.objects.bulk_create(cls._build(service_type, service_type.objects.filter(pk__in=ids)))
+
+    @classmethod
+    def refresh_roles(cls, role_ids):
+        """Replace rows of services managed by roles after roles or their accounts changed"""
+        cls.objects.filter(contractor_id__in=role_ids).delete()
+        for service_type in get_service_types():
+            cls.objects.bulk_create(cls._build(service_type, service_type.objects.filter(contractor_id__in=role_ids)))
+
+    @classmethod
+    def refresh_roots(cls, organisation_ids=None):
+        """Set root_id of rows under organisations, all rows when organisation_ids is None"""
+        rows = cls.objects.all()
+        if organisation_ids is not None:
+            rows = rows.filter(organisation_id__in=organisation_ids)
+        roots = OrganisationClosure.get_roots(organisation_ids)
+        by_root = {}
+        for organisation_id, root_id in roots.items():
+            by_root.setdefault(root_id, []).append(organisation_id)
+        # Organisations without ancestors are their own roots, found by a subquery not a list of all of them
+        rows.exclude(organisation_id__in=OrganisationClosure.objects.values('descendant_id')).update(
+            root_id=F('organisation_id'))
+        for root_id, ids in by_root.items():
+            rows.filter(organisation_id__in=ids).update(root_id=root_id)
+
+    @classmethod
+    def search(cls, **filters):
+        """Get rows matching all filters, which are names in FILTERS, e.g. billing_org_id=1"""
+        unknown = set(filters) - set(cls.FILTERS)
+        if unknown:
+            raise ValueError('Cannot filter by %s' % ', '.join(sorted(unknown)))
+        return cls.objects.filter(**filters).order_by()
+
+    @classmethod
+    def summarise(cls, group_by, **filters):
+        """Count services of each service type grouped by a name in GROUPS after filtering
+
+           Returns a list of {group_by: value, 'service_type': type, 'count': number}.
+        """
+        if group_by not in cls.GROUPS:
+            raise ValueError('Cannot group by %s' % group_by)
+        fields = [group_by] if group_by == 'service_type' else [group_by, 'service_type']
+        return list(cls.search(**filters).values(*fields).annotate(count=Count('pk')).order_by(*fields))
+
+
+def _service_saved(sender, instance, raw, **kwargs):
+    if not raw:
+        ServiceOwnership.refresh(sender, [instance.pk])
+
+
+def _service_deleted(sender, instance, **kwargs):
+    ServiceOwnership.objects.filter(service_type=sender.__name__, service_id=instance.pk).delete()
+
+
+for service_type in get_service_types():
+    post_save.connect(_service_saved, sender=service_type)
+    post_delete.connect(_service_deleted, sender=service_type)
+
+
+@receiver(post_save, sender=Role)
+def _role_saved(sender, instance, raw, **kwargs):
+    if not raw:
+        ServiceOwnership.refresh_roles([instance.pk])
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def _account_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        ServiceOwnership.refresh_roles([instance.role_id])
+
+
+def _refresh_subtree(head_id):
+    subtree = [head_id]
+    subtree.extend(OrganisationClosure.objects.filter(ancestor_id=head_id).values_list('descendant_id', flat=True))
+    ServiceOwnership.refresh_roots(subtree)
+
+
+# Receivers of OrganisationClosure are connected before these, so the closure is current
+@receiver(post_save, sender=Relationship)
+def _organisation_linked(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    changes = changed_organisation_edges(instance, created)
+    if changes is None:
+        ServiceOwnership.refresh_roots()
+        return
+    for _, head_id in changes[0] + changes[1]:
+        _refresh_subtree(head_id)
+
+
+@receiver(post_delete, sender=Relationship)
+def _organisation_unlinked(sender, instance, **kwargs):
+    if relationship_types.get_by_pk(instance.relationshiptype_id).name == ORGANISATION_RELATIONSHIP:
+        _refresh_subtree(instance.head_id)
+
+
+@receiver(relationships_created, sender=Relationship)
+def _organisations_linked_in_bulk(sender, relationships, **kwargs):
+    if any(relationship_types.get_by_pk(rel.relationshiptype_id).name == ORGANISATION_RELATIONSHIP
+           for rel in relationships):
+        ServiceOwnership.refresh_roots()
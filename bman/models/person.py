@@ -1,9 +1,18 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 from django.core import validators
 
-from .organisation import Organisation
-from .relationship import RelationshipType, Relationship
+from .organisation import Organisation, BILLING_VERSION_KEY
+from .relationship import RelationshipType
+from .registry import relationship_types
+from .utils import bump_cache_version, traverse
+
+# Names of RelationshipTypes of supervision: from an employee to a student, both are roles
+SUPERVISION_RELATIONSHIP = 'Supervision'
+SUPERVISOR_RELATIONSHIP = 'Employment'
+STUDENT_RELATIONSHIP = 'Study'
 
 
 class Person(models.Model):
@@ -30,10 +39,16 @@ class Person(models.Model):
         return '%s %s' % (self.first_name, self.last_name)
 
     def get_all_services(self):
-        """All services this Person linked to"""
+        """All services this Person linked to, in the order of roles
+
+           There is one query for roles and one for each kind of service.
+        """
+        from .service import get_services_of
+        role_ids = list(self.role_set.values_list('pk', flat=True))
+        by_role = get_services_of(persons=[self])
         services = []
-        for role in self.role_set.all():
-            services.extend(role.get_all_services())
+        for role_id in role_ids:
+            services.extend(by_role.get(role_id, []))
         return services
 
     def get_service(self, name=None):
@@ -70,7 +85,9 @@ class Role(models.Model):
 
     def __str__(self):
         """Role description read from Orgainsation to Person"""
-        return "%s %s %s" % (self.organisation, self.relationshiptype.forward, self.person)
+        # Type from the registry: lists of roles only need person and organisation selected
+        rel_type = relationship_types.get_by_pk(self.relationshiptype_id)
+        return "%s %s %s" % (self.organisation, rel_type.forward, self.person)
 
     def to_dict(self):
         """Convert all necessary related objects into a dict for clients
@@ -91,16 +108,13 @@ class Role(models.Model):
     @property
     def backward(self):
         """Role description read from Person to Orgainsation"""
-        return "%s %s %s" % (self.person, self.relationshiptype.backward, self.organisation)
+        rel_type = relationship_types.get_by_pk(self.relationshiptype_id)
+        return "%s %s %s" % (self.person, rel_type.backward, self.organisation)
 
     def get_all_services(self):
         """All services this role linked to"""
-        services = []
-        # better to auto-discover services from which to query
-        services.extend(self.accessservice_set.all())
-        services.extend(self.rds_set.all())
-        services.extend(self.nectar_set.all())
-        return services
+        from .service import get_services_of
+        return get_services_of(roles=[self]).get(self.pk, [])
 
     def get_service(self, name=None):
         """Get a service of a role linked to
@@ -118,21 +132,42 @@ class Role(models.Model):
 
     def get_students(self):
         # Only empolyee can be a supervisor
-        students = []
-        if self.relationshiptype.name == 'Employment':
-            sup_type = RelationshipType.objects.get(name='Supervision')
-            student_rels = Relationship.objects.filter(relationshiptype=sup_type, tail_id=self.pk)
-            students = [Role.objects.get(pk=rel.head_id).person for rel in student_rels]
-        return students
+        return Role.get_supervision([self])[self.pk]['students']
 
     def get_supervisors(self):
         # Only student can have supervisors
-        supervisors = []
-        if self.relationshiptype.name == 'Study':
-            sup_type = RelationshipType.objects.get(name='Supervision')
-            supervisor_rels = Relationship.objects.filter(relationshiptype=sup_type, head_id=self.pk)
-            supervisors = [Role.objects.get(pk=rel.tail_id).person for rel in supervisor_rels]
-        return supervisors
+        return Role.get_supervision([self])[self.pk]['supervisors']
+
+    @classmethod
+    def get_supervision(cls, roles):
+        """Get students and supervisors of many roles at once
+
+           Returns a dictionary of role pk to {'students': [Person], 'supervisors': [Person]}
+           in the order links were created. Only employees have students and only students
+           have supervisors. Links are traversed from employees forward and from students
+           backward, one query each, and the roles at the other ends are loaded with their
+           persons in another one.
+        """
+        supervision = {role.pk: {'students': [], 'supervisors': []} for role in roles}
+        names = {role.pk: relationship_types.get_by_pk(role.relationshiptype_id).name for role in roles}
+        try:
+            rel_type = relationship_types.get(SUPERVISION_RELATIONSHIP)
+        except RelationshipType.DoesNotExist:
+            return supervision
+
+        found = []
+        for kind, end_type, direction in (('students', SUPERVISOR_RELATIONSHIP, 'forward'),
+                                          ('supervisors', STUDENT_RELATIONSHIP, 'backward')):
+            ids = [pk for pk, name in names.items() if name == end_type]
+            if ids:
+                hops = traverse(('role', ids), rel_type, direction, hydrate=False, per_source=True)
+                found.extend((kind, hop.source_id, hop.target_id) for hop in hops)
+        if found:
+            linked = Role.objects.select_related('person').in_bulk({target_id for _, _, target_id in found})
+            for kind, role_id, other_id in found:
+                if other_id in linked:
+                    supervision[role_id][kind].append(linked[other_id].person)
+        return supervision
 
 
 class Account(models.Model):
@@ -157,5 +192,26 @@ class Account(models.Model):
     # for certain service? catalog = models.ForeignKey(Catalog)
     billing_org = models.ForeignKey(Organisation, blank=True, null=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Saves only invalidate cached billing organisations when billing_org has changed
+        instance._loaded_billing_org_id = instance.__dict__.get('billing_org_id')
+        return instance
+
     def __str__(self):
         return "%s belongs to %s" % (self.username, self.role.person)
+
+
+@receiver(post_save, sender=Account)
+def _billing_org_saved(sender, instance, created, **kwargs):
+    if created or not hasattr(instance, '_loaded_billing_org_id') \
+            or instance._loaded_billing_org_id != instance.billing_org_id:
+        bump_cache_version(BILLING_VERSION_KEY)
+    instance._loaded_billing_org_id = instance.billing_org_id
+
+
+@receiver(post_delete, sender=Account)
+def _billing_org_deleted(sender, instance, **kwargs):
+    if instance.billing_org_id is not None:
+        bump_cache_version(BILLING_VERSION_KEY)
@@ -0,0 +1,119 @@
+"""Process-wide lookups of small tables which are loaded from fixtures
+
+A Registry loads all rows of its model when it is first used, so importing modules
+which use it does not run queries. It is cleared when a row is saved or deleted in the
+same process, and reloaded after settings.BMAN_REGISTRY_TIMEOUT seconds (default is 300)
+for changes made by other processes. A missed key reloads the table once before
+DoesNotExist is raised, then the miss is remembered for the same timeout, or until a row
+is saved or deleted in this process, so looking up a missing row again runs no query.
+Misses are not remembered within transactions, the row may be created before they commit.
+
+A row saved or deleted within a transaction may be rolled back. Until the registry is used
+outside transactions again, rows loaded after such a change are only kept while the
+savepoint they were loaded in is open, and not at all when it was loaded outside any
+savepoint, where the end of the transaction cannot be told.
+
+Instances returned are shared, do not change them.
+"""
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+
+
+def _savepoints():
+    """Get ids of savepoints open in the current transaction, None outside transactions"""
+    return tuple(connection.savepoint_ids) if connection.in_atomic_block else None
+
+
+class Registry(object):
+    def __init__(self, key=('name',)):
+        self.key = key
+        self.model = None
+        # If rows have changed in a transaction which has not been seen to end
+        self._changed_in_transaction = False
+        self.clear()
+
+    def bind(self, model):
+        """Set the model of this registry and connect signal handlers to it"""
+        self.model = model
+        post_save.connect(self._changed, sender=model, weak=False)
+        post_delete.connect(self._changed, sender=model, weak=False)
+
+    def _changed(self, sender, **kwargs):
+        self.clear()
+        if connection.in_atomic_block:
+            self._changed_in_transaction = True
+
+    def clear(self):
+        self._by_key = None
+        self._by_pk = None
+        self._loaded_at = 0
+        # Savepoints open when rows were loaded after a change in a transaction
+        self._loaded_in = None
+        # {key: time of the reload which did not find it}, of keys and of pks
+        self._missed_keys = {}
+        self._missed_pks = {}
+
+    def _timeout(self):
+        return getattr(settings, 'BMAN_REGISTRY_TIMEOUT', 300)
+
+    def _load(self):
+        rows = list(self.model.objects.order_by('pk'))
+        by_key = {}
+        for row in rows:
+            # Keeps the first one if key is not unique
+            by_key.setdefault(tuple(getattr(row, field) for field in self.key), row)
+        self._by_pk = {row.pk: row for row in rows}
+        self._by_key = by_key
+        self._loaded_at = time.time()
+        self._loaded_in = _savepoints() if self._changed_in_transaction else None
+
+    def _is_current(self):
+        if self._by_key is None or time.time() - self._loaded_at > self._timeout():
+            return False
+        if self._loaded_in is None:
+            return True
+        # Loaded after a change in a transaction, valid while its savepoints are open
+        savepoints = _savepoints()
+        return bool(self._loaded_in) and savepoints is not None \
+            and savepoints[:len(self._loaded_in)] == self._loaded_in
+
+    def _ensure_loaded(self, reload=False):
+        if self._changed_in_transaction and not connection.in_atomic_block:
+            # The transaction has ended, committed or not
+            self._changed_in_transaction = False
+            reload = True
+        if reload or not self._is_current():
+            self._load()
+
+    def _lookup(self, rows, key, missed):
+        self._ensure_loaded()
+        if key not in rows():
+            missed_at = missed.get(key)
+            if missed_at is None or time.time() - missed_at > self._timeout():
+                self._ensure_loaded(reload=True)
+                if key not in rows() and not connection.in_atomic_block:
+                    missed[key] = self._loaded_at
+        try:
+            return rows()[key]
+        except KeyError:
+            raise self.model.DoesNotExist('%s %s does not exist' % (self.model.__name__, key))
+
+    def get(self, *key):
+        """Get an instance by values of key fields, e.g. get('Organisation')"""
+        return self._lookup(lambda: self._by_key, key, self._missed_keys)
+
+    def get_by_pk(self, pk):
+        return self._lookup(lambda: self._by_pk, pk, self._missed_pks)
+
+    def all(self):
+        """Get all instances ordered by pk"""
+        self._ensure_loaded()
+        return list(self._by_pk.values())
+
+
+relationship_types = Registry()
+catalogs = Registry()
+event_types = Registry(key=('entity', 'name'))
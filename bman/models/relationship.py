@@ -2,12 +2,23 @@ from django.core import validators
 
 from django.apps import apps
 
-from django.db import models
+from django.db import models, transaction
+from django.dispatch import Signal
+
+from .registry import relationship_types
 # from django.contrib.contenttypes.models import ContentType
 
 # Used in django.apps.get_model and in case re-package this module in the future for a better name
 app_name = __name__.split('.')[0]
 
+# Sent after RelationshipManager.bulk_link because bulk_create does not send post_save.
+# bulk_create of Django 1.8 does not set pk, receivers can only use type, tail_id and head_id.
+relationships_created = Signal(providing_args=['relationships'])
+
+TAIL_CONSTRAINT_ERROR = 'Tail constraint is not fulfiled.'
+SELF_POINTING_ERROR = 'Relationship with the same type at both ends cannot be the same identity.'
+EXISTS_ERROR = 'Relationship already exists.'
+
 
 class RelationshipType(models.Model):
     """Describe two entities from tail to head as in direct graph"""
@@ -42,14 +53,29 @@ class RelationshipType(models.Model):
             return True
 
 
-class RelationshipManager(models.Manager):
+class RelationshipQuerySet(models.QuerySet):
+    _with_ends = False
+
+    def with_ends(self):
+        """Attach tail and head entities to fetched Relationships, see Relationship.attach_ends"""
+        return self._clone(_with_ends=True)
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_with_ends', self._with_ends)
+        return super()._clone(*args, **kwargs)
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if self._with_ends and not fetched:
+            Relationship.attach_ends([rel for rel in self._result_cache if isinstance(rel, Relationship)])
+
+
+class RelationshipManager(models.Manager.from_queryset(RelationshipQuerySet)):
     def create(self, **kwargs):
         """Accept relationshiptype instance or name when creating"""
-        # relationshiptype is defined by name not instance
-        if isinstance(kwargs['relationshiptype'], str):
-            rel_type = RelationshipType.objects.get(name=kwargs['relationshiptype'])
-        else:
-            rel_type = kwargs['relationshiptype']
+        # relationshiptype can be defined by name not instance
+        rel_type = Relationship._ensure_type(kwargs['relationshiptype'])
 
         # Not ready to go ContextType route yet as I am still thinking these are not simple fk: it needs RelationshipType
         # and get_model is flexible enough
@@ -62,6 +88,61 @@ class RelationshipManager(models.Manager):
         values = {'relationshiptype': rel_type, 'tail_id': kwargs['tail_id'], 'head_id': kwargs['head_id']}
         return super(RelationshipManager, self).create(**values)
 
+    def bulk_link(self, edges, batch_size=500):
+        """Create Relationships in one transaction after checking them in sets
+
+           edges is a list of dict which has the same keys of create: relationshiptype
+           (name or instance), tail_id and head_id. Self-pointing edges, existing edges and
+           edges break tail constraint, including by an earlier edge in the same batch, are
+           rejected. Existing edges are read by one query per RelationshipType for every
+           batch_size heads.
+
+           Checks and inserts run in one transaction which locks the RelationshipType rows
+           of the edges first, so concurrent calls with the same types wait for each other
+           instead of passing the same checks and creating duplicates.
+
+           Returns a tuple: a list of created Relationships, a list of (edge, reason) of
+           rejected edges. Signal relationships_created is sent with the created ones.
+           Created Relationships have no pk, bulk_create of Django 1.8 does not set it.
+        """
+        by_type = {}
+        for edge in edges:
+            rel_type = Relationship._ensure_type(edge['relationshiptype'])
+            by_type.setdefault(rel_type.pk, (rel_type, []))[1].append(edge)
+
+        with transaction.atomic():
+            # Ordered by pk, so calls lock the same types in the same order
+            list(RelationshipType.objects.select_for_update().filter(pk__in=list(by_type)).order_by('pk'))
+            created, rejected = self._check_edges(by_type.values(), batch_size)
+            self.bulk_create(created, batch_size=batch_size)
+            relationships_created.send(sender=self.model, relationships=created)
+        return created, rejected
+
+    def _check_edges(self, typed_edges_of_types, batch_size):
+        """Get Relationships to create and (edge, reason) of rejected edges of [(type, edges)]"""
+        created, rejected = [], []
+        for rel_type, typed_edges in typed_edges_of_types:
+            heads = list({edge['head_id'] for edge in typed_edges})
+            existing = set()
+            for i in range(0, len(heads), batch_size):
+                existing.update(self.filter(relationshiptype=rel_type, head_id__in=heads[i:i + batch_size])
+                                .order_by().values_list('tail_id', 'head_id'))
+            has_tail = {head for _, head in existing}
+
+            for edge in typed_edges:
+                pair = (edge['tail_id'], edge['head_id'])
+                if not rel_type.validate(*pair):
+                    rejected.append((edge, SELF_POINTING_ERROR))
+                elif pair in existing:
+                    rejected.append((edge, EXISTS_ERROR))
+                elif rel_type.tconstraint and pair[1] in has_tail:
+                    rejected.append((edge, TAIL_CONSTRAINT_ERROR))
+                else:
+                    existing.add(pair)
+                    has_tail.add(pair[1])
+                    created.append(Relationship(relationshiptype=rel_type, tail_id=pair[0], head_id=pair[1]))
+        return created, rejected
+
 
 # TODO: May valid if tail and head objects exist
 class Relationship(models.Model):
@@ -83,31 +164,72 @@ class Relationship(models.Model):
     objects = RelationshipManager()
 
     class Meta:
+        # Only for listing, traversal queries should call order_by() to avoid sorting
         ordering = ['tail_id', 'relationshiptype']
+        # Every traversal filters by type and one end
+        index_together = [('relationshiptype', 'tail_id'), ('relationshiptype', 'head_id')]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Receivers of post_save tell what an edit has changed, e.g. moved edges of the hierarchy
+        instance._loaded_edge = tuple(instance.__dict__.get(field) for field in ('relationshiptype_id', 'tail_id', 'head_id'))
+        return instance
 
     def save(self, *args, **kwargs):
         rel_type = self.relationshiptype
         if rel_type.tconstraint:
-            rslt = Relationship.objects.filter(head_id=self.head_id, relationshiptype=rel_type)
-            if len(rslt) > 0:
-                raise ValueError('Tail constraint is not fulfiled.')
+            if Relationship.objects.filter(head_id=self.head_id, relationshiptype=rel_type).exists():
+                raise ValueError(TAIL_CONSTRAINT_ERROR)
 
         if rel_type.validate(self.tail_id, self.head_id):
             super().save(*args, **kwargs)
+            self._loaded_edge = (self.relationshiptype_id, self.tail_id, self.head_id)
         else:
             print('Values %d, %d are not valid for %s' % (self.tail_id, self.head_id, rel_type.description))
-            raise ValueError('Relationship with the same type at both ends cannot be the same identity.')
+            raise ValueError(SELF_POINTING_ERROR)
 
     def __str__(self):
         r = self.relationshiptype
 
-        tail = apps.get_model(app_name, r.entity_tail).objects.get(pk=self.tail_id)
-        head = apps.get_model(app_name, r.entity_head).objects.get(pk=self.head_id)
-
         if self.direction == 'F':
-            return "%s %s %s" % (tail, r.forward, head)
+            return "%s %s %s" % (self.tail, r.forward, self.head)
         else:
-            return "%s %s %s" % (head, r.backward, tail)
+            return "%s %s %s" % (self.head, r.backward, self.tail)
+
+    @property
+    def tail(self):
+        """Entity at the tail end, loaded when it has not been attached"""
+        if not hasattr(self, '_tail'):
+            self._tail = apps.get_model(app_name, self.relationshiptype.entity_tail).objects.get(pk=self.tail_id)
+        return self._tail
+
+    @property
+    def head(self):
+        """Entity at the head end, loaded when it has not been attached"""
+        if not hasattr(self, '_head'):
+            self._head = apps.get_model(app_name, self.relationshiptype.entity_head).objects.get(pk=self.head_id)
+        return self._head
+
+    @classmethod
+    def attach_ends(cls, relationships):
+        """Load tail and head entities of relationships with one in_bulk per entity type
+
+           Types of relationships come from the registry. Ends which do not exist are None.
+        """
+        wanted = {}
+        for rel in relationships:
+            rel.relationshiptype = relationship_types.get_by_pk(rel.relationshiptype_id)
+            wanted.setdefault(rel.relationshiptype.entity_tail, set()).add(rel.tail_id)
+            wanted.setdefault(rel.relationshiptype.entity_head, set()).add(rel.head_id)
+
+        loaded = {}
+        for entity_name, ids in wanted.items():
+            loaded[entity_name] = apps.get_model(app_name, entity_name).objects.in_bulk(list(ids))
+        for rel in relationships:
+            rel._tail = loaded[rel.relationshiptype.entity_tail].get(rel.tail_id)
+            rel._head = loaded[rel.relationshiptype.entity_head].get(rel.head_id)
+        return relationships
 
     @classmethod
     def _ensure_type(cls, rel_type):
@@ -116,7 +238,7 @@ class Relationship(models.Model):
            RelationshipType or an instance, returns an instance of RelationshipType.
         """
         if isinstance(rel_type, str):
-            rel_type = RelationshipType.objects.get(name=rel_type)
+            rel_type = relationship_types.get(rel_type)
         return rel_type
 
     @classmethod
@@ -129,9 +251,9 @@ class Relationship(models.Model):
         """
         rel_type = cls._ensure_type(rel_type)
         if end == 'head':
-            return Relationship.objects.filter(relationshiptype=rel_type, head_id=entity.pk)
+            return Relationship.objects.filter(relationshiptype=rel_type, head_id=entity.pk).order_by()
         else:
-            return Relationship.objects.filter(relationshiptype=rel_type, tail_id=entity.pk)
+            return Relationship.objects.filter(relationshiptype=rel_type, tail_id=entity.pk).order_by()
 
     @classmethod
     def tail_only(cls, rel_type):
@@ -145,6 +267,6 @@ class Relationship(models.Model):
         """
         # select distinct tail_id from bman_relationship where relationshiptype_id=1 and tail_id not in (select head_id from bman_relationship where relationshiptype_id=1);
         rel_type = cls._ensure_type(rel_type)
-        return Relationship.objects.filter(relationshiptype=rel_type) \
-            .exclude(tail_id__in=Relationship.objects.filter(relationshiptype=rel_type).values_list('head_id')) \
+        return Relationship.objects.filter(relationshiptype=rel_type).order_by() \
+            .exclude(tail_id__in=Relationship.objects.filter(relationshiptype=rel_type).order_by().values_list('head_id')) \
             .distinct().values_list('tail_id', flat=True)
@@ -0,0 +1,209 @@
+"""Prefix search of people and organisations by name
+
+Names are split into lower-case words without accents which are stored in SearchTerm
+with a weight of the field they come from. A word of a query matches terms it is a prefix
+of; the prefix is looked up as a range, term >= 'smi' and term < 'smj', so the index on term
+is used by SQLite and PostgreSQL alike. Words shorter than MIN_PREFIX_LENGTH only match terms
+equal to them, a range of one or two letters covers too much of the table. Rows are
+maintained by signal handlers, names changed without signals, e.g. by update or loaddata,
+need `python manage.py buildsearch`.
+"""
+import re
+import unicodedata
+
+from django.db import models
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .person import Person, Role
+from .organisation import Organisation
+
+MAX_TERM_LENGTH = 50
+# Shorter words are not used as prefixes
+MIN_PREFIX_LENGTH = 3
+# Weights of fields, abbreviations and last names are more specific than the others
+FIELDS = {
+    'person': (Person, (('last_name', 3), ('first_name', 2))),
+    'organisation': (Organisation, (('abbreviation', 3), ('name', 2))),
+}
+# A word matched in full counts more than a prefix of it
+EXACT_BONUS = 1
+# Querysets of models which can be looked up by autocomplete, with what __str__ uses selected
+LOOKUPS = {
+    'person': lambda: Person.objects.all(),
+    'organisation': lambda: Organisation.objects.all(),
+    'role': lambda: Role.objects.select_related('person', 'organisation'),
+}
+
+
+def tokenize(text):
+    """Split text into lower-case words without accents"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return [word[:MAX_TERM_LENGTH] for word in re.findall(r'\w+', text)]
+
+
+class SearchTerm(models.Model):
+    """A word of a name of a Person or an Organisation"""
+    term = models.CharField(max_length=MAX_TERM_LENGTH)
+    entity = models.CharField(max_length=30)
+    entity_id = models.PositiveIntegerField()
+    weight = models.PositiveSmallIntegerField()
+
+    class Meta:
+        index_together = [('entity', 'term'), ('entity', 'entity_id')]
+
+    def __str__(self):
+        return "%s of %s %d" % (self.term, self.entity, self.entity_id)
+
+    @classmethod
+    def _terms_of(cls, entity, instance):
+        weights = {}
+        for field, weight in FIELDS[entity][1]:
+            for term in tokenize(getattr(instance, field)):
+                weights[term] = max(weights.get(term, 0), weight)
+        return [cls(term=term, entity=entity, entity_id=instance.pk, weight=weight)
+                for term, weight in weights.items()]
+
+    @classmethod
+    def index(cls, instance):
+        """Replace terms of a Person or an Organisation"""
+        entity = instance.__class__.__name__.lower()
+        cls.objects.filter(entity=entity, entity_id=instance.pk).delete()
+        cls.objects.bulk_create(cls._terms_of(entity, instance))
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the whole table from all people and organisations, returns the number of terms"""
+        terms = []
+        for entity, (model, fields) in FIELDS.items():
+            for instance in model.objects.order_by().only(*[field for field, _ in fields]).iterator():
+                terms.extend(cls._terms_of(entity, instance))
+        cls.objects.all().delete()
+        cls.objects.bulk_create(terms, batch_size=500)
+        return len(terms)
+
+    @classmethod
+    def _terms_matching(cls, word, entity):
+        """Get a queryset of terms of an entity which start with word, or equal it if it is short"""
+        if len(word) < MIN_PREFIX_LENGTH:
+            terms = Q(term=word)
+        else:
+            # The next string after all strings starting with word
+            upper = word[:-1] + chr(ord(word[-1]) + 1)
+            terms = Q(term__gte=word, term__lt=upper)
+        return cls.objects.filter(terms, entity=entity).order_by()
+
+    @classmethod
+    def _matches(cls, word, entities):
+        """Get {(entity, entity_id): score} of terms which start with word, or equal it if it is short"""
+        matches = {}
+        for entity in entities:
+            rows = cls._terms_matching(word, entity).values_list('entity_id', 'term', 'weight')
+            for entity_id, term, weight in rows:
+                score = weight + (EXACT_BONUS if term == word else 0)
+                key = (entity, entity_id)
+                matches[key] = max(matches.get(key, 0), score)
+        return matches
+
+
+def search(q, entity=None, limit=20):
+    """Find people and organisations of which names have words starting with every word of q
+
+       Words shorter than MIN_PREFIX_LENGTH have to be whole words of names.
+       entity limits results to 'person' or 'organisation'. Returns a list of
+       {'entity', 'id', 'name', 'score'} ordered by score, the sum of the best weight each
+       word of q matched, then by id so only the results returned are loaded. There is one
+       query for each word and entity, and one to load each entity in results.
+    """
+    entities = [entity] if entity else sorted(FIELDS.keys())
+    unknown = set(entities) - set(FIELDS.keys())
+    if unknown:
+        raise ValueError('Cannot search %s' % ', '.join(sorted(unknown)))
+    words = sorted(set(tokenize(q)), key=len, reverse=True)
+    if not words:
+        return []
+
+    scores = None
+    for word in words:
+        matches = SearchTerm._matches(word, entities)
+        if scores is None:
+            scores = matches
+        else:
+            scores = {key: score + matches[key] for key, score in scores.items() if key in matches}
+        if not scores:
+            return []
+
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0][1], item[0][0]))[:int(limit)]
+    loaded = {}
+    for name in entities:
+        ids = [entity_id for (matched, entity_id), _ in ranked if matched == name]
+        loaded[name] = FIELDS[name][0].objects.in_bulk(ids) if ids else {}
+    return [{'entity': name, 'id': entity_id, 'name': str(loaded[name][entity_id]), 'score': score}
+            for (name, entity_id), score in ranked if entity_id in loaded[name]]
+
+
+def _search_roles(q, limit):
+    """Find roles of which person or organisation match every word of q, ranked like search"""
+    words = sorted(set(tokenize(q)), key=len, reverse=True)
+    if not words:
+        return []
+    matches = [SearchTerm._matches(word, ['person', 'organisation']) for word in words]
+    # Every role found matches the longest word, candidates are selected by subqueries of its terms
+    roles = Role.objects.filter(
+        Q(person_id__in=SearchTerm._terms_matching(words[0], 'person').values('entity_id'))
+        | Q(organisation_id__in=SearchTerm._terms_matching(words[0], 'organisation').values('entity_id'))) \
+        .order_by().values_list('pk', 'person_id', 'organisation_id')
+
+    scores = {}
+    for pk, person_id, organisation_id in roles:
+        score = 0
+        for found in matches:
+            best = max(found.get(('person', person_id), 0), found.get(('organisation', organisation_id), 0))
+            if not best:
+                break
+            score += best
+        else:
+            scores[pk] = score
+    return [pk for pk, _ in sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]]
+
+
+def lookup(target, q, limit=20):
+    """Get [{'id', 'label'}] of people, organisations or roles matching q for autocomplete
+
+       The queries do not depend on sizes of tables: words of q are searched, and only
+       the results are loaded with what their labels need.
+    """
+    if target not in LOOKUPS:
+        raise ValueError('Cannot look up %s' % target)
+    limit = int(limit)
+    if target == 'role':
+        ids = _search_roles(q, limit)
+    else:
+        ids = [result['id'] for result in search(q, target, limit)]
+    loaded = LOOKUPS[target]().in_bulk(ids)
+    return [{'id': pk, 'label': str(loaded[pk])} for pk in ids if pk in loaded]
+
+
+def get_label(target, pk):
+    """Get the label of an instance for an autocomplete field, None if pk is empty or does not exist"""
+    try:
+        pk = int(pk)
+    except (TypeError, ValueError):
+        return None
+    instance = LOOKUPS[target]().filter(pk=pk).first()
+    return None if instance is None else str(instance)
+
+
+@receiver(post_save, sender=Person)
+@receiver(post_save, sender=Organisation)
+def _index_names(sender, instance, raw, **kwargs):
+    if not raw:
+        SearchTerm.index(instance)
+
+
+@receiver(post_delete, sender=Person)
+@receiver(post_delete, sender=Organisation)
+def _unindex_names(sender, instance, **kwargs):
+    SearchTerm.objects.filter(entity=sender.__name__.lower(), entity_id=instance.pk).delete()
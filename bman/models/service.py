@@ -1,6 +1,15 @@
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Count, Sum, Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 from .person import Role, Account
+from .organisation import Organisation, OrganisationClosure
+from .relationship import Relationship, relationships_created
+from .utils import get_cache_version, bump_cache_version, is_true
+
+CAPACITY_VERSION_KEY = 'bman.rds.capacity.version'
 
 
 def extract_fields(source, fields):
@@ -45,6 +54,8 @@ class BasicService(models.Model):
         ('S', 'suspended'),
         ('D', 'ended'),
     )
+    # Field (or lookup) which identifies a service to people, used by ServiceOwnership
+    IDENTIFIER = 'pk'
     # Might be a one-to-one, at least spreadsheet only allows one
     contractor = models.ForeignKey(Role)  # Manager of a service
     start_date = models.DateField(blank=True, null=True)
@@ -72,6 +83,18 @@ class BasicService(models.Model):
         except Account.DoesNotExist:
             return self.contractor.organisation
 
+    @classmethod
+    def with_related(cls, services):
+        """Select related objects used by __str__ and to_dict on a queryset of this service type"""
+        related = [field.name for field in cls._meta.fields if field.is_relation]
+        return services.select_related(
+            'contractor__person', 'contractor__organisation', 'contractor__account__billing_org', *related)
+
+    @classmethod
+    def to_dicts(cls, services):
+        """Convert a queryset of services like to_dict with the same number of queries for any length"""
+        return [service.to_dict() for service in cls.with_related(services)]
+
     def to_dict(self):
         """Convert all necessary related objects into a dict for clients
         """
@@ -89,6 +112,7 @@ class BasicService(models.Model):
 
 class AccessService(BasicService):
     """Services only need a name"""
+    IDENTIFIER = 'catalog__name'
     catalog = models.ForeignKey(Catalog)
 
     def __str__(self):
@@ -99,6 +123,7 @@ class AccessService(BasicService):
 
 
 class RDS(BasicService):
+    IDENTIFIER = 'allocation_num'
     allocation_num = models.CharField('Allocation number', max_length=100)
     filesystem = models.CharField(max_length=100, blank=True, default='')
     approved_size = models.PositiveIntegerField(help_text='In GB', default=0)
@@ -110,6 +135,71 @@ class RDS(BasicService):
     def descriptive_name(self):
         return 'RDS'
 
+    @classmethod
+    def get_capacity(cls, group_by='billing_org', top_id=None, subtree=False, status=None):
+        """Count RDS and sum approved_size of groups: {group id (str): {'name', 'count', 'size'}}
+
+           group_by is 'billing_org' (the contractor's organisation without an account, like
+           billing_organisation), 'organisation' of contractors or 'root' of their organisations.
+           top_id limits RDS to contractors in the subtree of an organisation. With subtree,
+           totals of organisations include their descendants. status filters RDS by STATUS.
+
+           Sums are done by the database grouped by organisation and billing organisation;
+           groups are merged in memory. Results are cached until RDS, roles, accounts or
+           relationships change.
+        """
+        if group_by not in ('billing_org', 'organisation', 'root'):
+            raise ValueError('group_by has to be billing_org, organisation or root')
+        subtree = is_true(subtree)
+        key = 'bman.rds.capacity.%s.%s.%s.%s.%s' % (
+            get_cache_version(CAPACITY_VERSION_KEY), group_by, top_id, subtree, status)
+        capacity = cache.get(key)
+        if capacity is None:
+            capacity = cls._sum_capacity(group_by, top_id, subtree, status)
+            cache.set(key, capacity)
+        return capacity
+
+    @classmethod
+    def _sum_capacity(cls, group_by, top_id, subtree, status):
+        services = cls.objects.order_by()
+        if status:
+            services = services.filter(status=status)
+        if top_id is not None:
+            top_id = int(top_id)
+            descendants = OrganisationClosure.objects.filter(ancestor_id=top_id).values('descendant_id')
+            services = services.filter(Q(contractor__organisation_id=top_id)
+                                       | Q(contractor__organisation_id__in=descendants))
+        sums = services.values('contractor__organisation_id', 'contractor__account__billing_org_id') \
+            .annotate(count=Count('pk'), size=Sum('approved_size')) \
+            .values_list('contractor__organisation_id', 'contractor__account__billing_org_id', 'count', 'size')
+        sums = list(sums)
+
+        roots = OrganisationClosure.get_roots({org_id for org_id, _, _, _ in sums}) if group_by == 'root' else {}
+        totals = {}
+        for org_id, billing_org_id, count, size in sums:
+            if group_by == 'billing_org':
+                group = billing_org_id or org_id
+            elif group_by == 'organisation':
+                group = org_id
+            else:
+                group = roots.get(org_id, org_id)
+            total = totals.setdefault(group, {'count': 0, 'size': 0})
+            total['count'] += count
+            total['size'] += size or 0
+
+        if subtree and group_by != 'root':
+            own = {group: dict(total) for group, total in totals.items()}
+            pairs = OrganisationClosure.objects.filter(descendant_id__in=list(own.keys()))
+            if top_id is not None:
+                pairs = pairs.filter(Q(ancestor_id=top_id) | Q(ancestor_id__in=descendants))
+            for ancestor_id, descendant_id in pairs.values_list('ancestor_id', 'descendant_id'):
+                total = totals.setdefault(ancestor_id, {'count': 0, 'size': 0})
+                total['count'] += own[descendant_id]['count']
+                total['size'] += own[descendant_id]['size']
+
+        names = dict(Organisation.objects.filter(pk__in=list(totals.keys())).values_list('pk', 'name'))
+        return {str(group): dict(total, name=names.get(group, '')) for group, total in totals.items()}
+
     def to_dict(self):
         """Convert all necessary related objects into a dict for clients
         """
@@ -123,6 +213,7 @@ class Nectar(BasicService):
     """Provide tracking to Nectar projects
     One project for billing purpose only allow to have one contractor.
     """
+    IDENTIFIER = 'openstack_id'
     tenant = models.CharField(help_text='Nectar project name', max_length=100, blank=True, default='')
     openstack_id = models.CharField(max_length=36, unique=True)
     description = models.TextField(blank=True, default='')
@@ -142,3 +233,60 @@ class Nectar(BasicService):
             openstack_id=self.openstack_id,
             tenant=self.tenant)
         return base_info
+
+
+def get_service_types():
+    """Get concrete subclasses of BasicService in the order they are defined
+
+       New kinds of services are found without being listed anywhere else.
+    """
+    service_types, pending = [], list(BasicService.__subclasses__())
+    while pending:
+        service_type = pending.pop(0)
+        if not service_type._meta.abstract and service_type not in service_types:
+            service_types.append(service_type)
+        pending.extend(service_type.__subclasses__())
+    return service_types
+
+
+def select_services(service_type):
+    """Get a queryset of a service type with related objects used by __str__ and to_dict selected"""
+    return service_type.with_related(service_type.objects.all())
+
+
+def get_services_of(roles=None, persons=None):
+    """Get services of many roles or persons grouped by role id: {role_id: [service, ...]}
+
+       roles and persons are lists of instances or ids. There is one query per service type
+       with contractor and other foreign keys like catalog selected (see select_services),
+       so services can be shown without more queries. Services of a role are in the order of
+       types, then the order they were created.
+    """
+    def _ids(items):
+        return [item.pk if isinstance(item, models.Model) else item for item in items]
+
+    if roles is not None:
+        condition = {'contractor_id__in': _ids(roles)}
+    elif persons is not None:
+        condition = {'contractor__person_id__in': _ids(persons)}
+    else:
+        raise ValueError('Either roles or persons is needed')
+
+    grouped = {}
+    for service_type in get_service_types():
+        for service in select_services(service_type).filter(**condition).order_by('pk'):
+            grouped.setdefault(service.contractor_id, []).append(service)
+    return grouped
+
+
+@receiver(post_save, sender=RDS)
+@receiver(post_delete, sender=RDS)
+@receiver(post_save, sender=Role)
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+@receiver(post_save, sender=Relationship)
+@receiver(post_delete, sender=Relationship)
+@receiver(relationships_created, sender=Relationship)
+def _capacity_changed(sender, **kwargs):
+    # Groups depend on contractors, billing organisations and the hierarchy, not only on RDS
+    bump_cache_version(CAPACITY_VERSION_KEY)
@@ -1,6 +1,16 @@
+import uuid
+from collections import namedtuple
+
+from django.apps import apps
+from django.core.cache import cache
 from django.db.models import Model, Q
 
-from .relationship import RelationshipType, Relationship
+from .relationship import app_name, RelationshipType, Relationship
+from .registry import relationship_types
+
+# One step of a traversal: source and target are None when entities are not hydrated
+Hop = namedtuple('Hop', ['depth', 'relationship', 'source_id', 'target_id', 'source', 'target'])
+
 
 def get_related(entity, rel_type_name=''):
     """Get related entities of an entity of a RelationshipType"""
@@ -10,10 +20,157 @@ def get_related(entity, rel_type_name=''):
     entity_name = entity.__class__.__name__.lower()
     pk = entity.pk
     if rel_type_name:
-        rel_types = [RelationshipType.objects.get(name=rel_type_name)]
+        rel_types = [relationship_types.get(rel_type_name)]
     else:
-        rel_types = RelationshipType.objects.filter(Q(entity_head=entity_name) | Q(entity_tail=entity_name))
+        rel_types = [rel_type for rel_type in relationship_types.all()
+                     if entity_name in (rel_type.entity_head, rel_type.entity_tail)]
     links = []
     for rel_type in rel_types:
-        links.extend(Relationship.objects.filter(Q(relationshiptype=rel_type), Q(head_id=pk) | Q(tail_id=pk)))
+        # Type in both branches so each can use its (relationshiptype, end) index
+        links.extend(Relationship.objects.filter(
+            Q(relationshiptype=rel_type, head_id=pk) | Q(relationshiptype=rel_type, tail_id=pk)).order_by())
     return links
+
+
+def _ensure_types(rel_types):
+    """Get a list of RelationshipType from names, instances or a mix of them"""
+    if rel_types is None:
+        return relationship_types.all()
+    if isinstance(rel_types, (str, RelationshipType)):
+        rel_types = [rel_types]
+    return [Relationship._ensure_type(rel_type) for rel_type in rel_types]
+
+
+def traverse(start, rel_types=None, direction='forward', depth=1, hydrate=True, select_related=None,
+             per_source=False):
+    """Expand Relationships breadth first from start entities and returns a list of Hop
+
+       start is a model instance, a list of them, or a tuple of (entity name, list of ids),
+       e.g. ('organisation', [1, 2]). rel_types can be a name or an instance of
+       RelationshipType, or a list of them; all types are used when it is None. Types
+       are only followed from entities at their starting end, so a traversal can go
+       through different types of entities.
+
+       direction is 'forward' (tail to head) or 'backward' (head to tail). depth is the
+       number of levels to expand, None for no limit. Every entity is only visited once
+       so cycles end the expansion. When per_source is True, an entity reached from
+       several sources has a hop from each of them, e.g. a student of two supervisors,
+       but it is still only expanded once.
+
+       There is one query per level. When hydrate is True, entities of hops are loaded
+       at the end by one in_bulk per entity type. select_related is an optional
+       dictionary of entity name to fields, e.g. {'role': ['person']}.
+    """
+    if direction not in ('forward', 'backward'):
+        raise ValueError('direction has to be either forward or backward')
+    forward = direction == 'forward'
+    near, far = ('tail', 'head') if forward else ('head', 'tail')
+
+    frontier = _start_frontier(start)
+    visited = set(frontier)
+    linked = set()
+
+    rel_types = {rel_type.pk: rel_type for rel_type in _ensure_types(rel_types)}
+    hops = []
+    level = 0
+    while frontier and (depth is None or level < depth):
+        level += 1
+        conditions = _level_conditions(frontier, rel_types, near)
+        if not conditions:
+            break
+        # no ordering in database, creation order of each level is kept in memory
+        rels = sorted(Relationship.objects.filter(conditions).order_by(), key=lambda r: r.pk)
+        frontier = _collect_hops(hops, level, rels, rel_types, near, far, visited, linked if per_source else None)
+
+    if hydrate and hops:
+        hops = _hydrate(hops, near, far, select_related or {})
+    return hops
+
+
+def _start_frontier(start):
+    """Get a set of (entity name, id) of start of traverse"""
+    if isinstance(start, tuple):
+        return {(start[0], entity_id) for entity_id in start[1]}
+    if isinstance(start, Model):
+        start = [start]
+    return {(entity.__class__.__name__.lower(), entity.pk) for entity in start}
+
+
+def _level_conditions(frontier, rel_types, near):
+    """Get a Q of Relationships of rel_types starting from entities in frontier at their near end"""
+    ids = {}
+    for entity_name, entity_id in frontier:
+        ids.setdefault(entity_name, set()).add(entity_id)
+    conditions = Q()
+    for rel_type in rel_types.values():
+        entity_name = getattr(rel_type, 'entity_' + near)
+        if entity_name in ids:
+            conditions |= Q(relationshiptype=rel_type.pk, **{near + '_id__in': ids[entity_name]})
+    return conditions
+
+
+def _collect_hops(hops, level, rels, rel_types, near, far, visited, linked=None):
+    """Append Hops of a level to hops and get the next frontier
+
+       Targets already visited are skipped, unless linked, a set of (source, target) kept
+       by traverse with per_source, is given and the pair has not been linked yet.
+    """
+    frontier = set()
+    for rel in rels:
+        rel.relationshiptype = rel_types[rel.relationshiptype_id]
+        target = (getattr(rel.relationshiptype, 'entity_' + far), getattr(rel, far + '_id'))
+        if linked is not None:
+            source = (getattr(rel.relationshiptype, 'entity_' + near), getattr(rel, near + '_id'))
+            if (source, target) in linked or source == target:
+                continue
+            linked.add((source, target))
+        elif target in visited:
+            continue
+        if target not in visited:
+            visited.add(target)
+            frontier.add(target)
+        hops.append(Hop(level, rel, getattr(rel, near + '_id'), target[1], None, None))
+    return frontier
+
+
+def _hydrate(hops, near, far, select_related):
+    wanted = {}
+    for hop in hops:
+        rel_type = hop.relationship.relationshiptype
+        wanted.setdefault(getattr(rel_type, 'entity_' + near), set()).add(hop.source_id)
+        wanted.setdefault(getattr(rel_type, 'entity_' + far), set()).add(hop.target_id)
+    loaded = {}
+    for entity_name, ids in wanted.items():
+        query = apps.get_model(app_name, entity_name).objects.all()
+        if entity_name in select_related:
+            query = query.select_related(*select_related[entity_name])
+        loaded[entity_name] = query.in_bulk(list(ids))
+
+    hydrated = []
+    for hop in hops:
+        rel_type = hop.relationship.relationshiptype
+        hydrated.append(hop._replace(
+            source=loaded[getattr(rel_type, 'entity_' + near)].get(hop.source_id),
+            target=loaded[getattr(rel_type, 'entity_' + far)].get(hop.target_id)))
+    return hydrated
+
+
+def get_cache_version(key):
+    """Get the version token stored in the cache under key, a new one when the cache has lost it
+
+       Cached results built from a version are stale once bump_cache_version(key) is called.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(key):
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def is_true(value):
+    """Check a flag which may come from a query string, e.g. subtree=true or subtree=1"""
+    return value in (True, 'true', 'True', '1')
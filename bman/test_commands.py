@@ -29,3 +29,34 @@ class CommandTest(unittest.TestCase):
             with patch.dict('bman.management.commands.ingest.importers', {'to_be_defined': mock}):
                 call_command('ingest', 'TEST_DATA_FILE', type='to_be_defined')
                 self.assertTrue(mock.called)
+
+
+class BenchmarkTest(django.test.TestCase):
+    def test_accounts_queries_are_constant(self):
+        from io import StringIO
+        out = StringIO()
+        call_command('benchmark', 'accounts', sizes='2,6', repeat=1, stdout=out)
+        queries = {}
+        # Lines are: size, name in 30 characters, milliseconds, queries
+        for line in out.getvalue().splitlines():
+            queries.setdefault(line[7:37].strip(), []).append(int(line.split()[-2]))
+        self.assertEqual(queries['get_extended_accounts'], [1, 1])
+        self.assertLess(queries['attributes of each account'][0], queries['attributes of each account'][1])
+
+
+class LoadCsvTest(django.test.TestCase):
+    def test_account_without_billing_organisation(self):
+        from bman.management.commands.loadcsv import _csv_to_account
+        from bman.models import RelationshipType, Organisation, Person, Role, RDS
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person=Person.objects.create(first_name='John', last_name='Smith'),
+                                   organisation=org, relationshiptype=rel_type)
+        account = _csv_to_account({'Username': 'john', 'Billing Organisation': ' '}, role)
+        self.assertEqual(account.billing_org.name, '')
+        other = Role.objects.create(person=Person.objects.create(first_name='Jane', last_name='Smith'),
+                                    organisation=org, relationshiptype=rel_type)
+        self.assertEqual(_csv_to_account({'Username': 'jane', 'Billing Organisation': ''}, other).billing_org,
+                         account.billing_org)
+        rds = RDS.objects.create(contractor=role, allocation_num='RDS-1', collection_name='data')
+        self.assertEqual(rds.to_dict()['billing_id'], account.billing_org.pk)
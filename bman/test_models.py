@@ -1,9 +1,12 @@
+from unittest.mock import patch
+
 from django.core.exceptions import ValidationError
+from django.db import connection, transaction, IntegrityError
 from django.test import TestCase
 
 from bman.models import (
-    RelationshipType, Relationship, Person, Organisation,
-    Role, Account, Catalog, AccessService)
+    RelationshipType, Relationship, Person, Organisation, OrganisationClosure,
+    Role, Account, Catalog, AccessService, RDS, Nectar, ServiceOwnership, SearchTerm)
 
 
 class PersonTestCase(TestCase):
@@ -30,10 +33,49 @@ class OrganisationTestCase(TestCase):
             entity_head='organisation',
             forward='is the parent organisation of',
             backward='is a sub-organisation of')
-        Organisation.objects.create(name="A School of University of Adelaide")
+        school = Organisation.objects.create(name="A School of University of Adelaide")
         Relationship.objects.create(tail_id=1, head_id=2, relationshiptype=rel_type)
         self.assertEqual(len(Organisation.get_tops()), 1)
 
+        group = Organisation.objects.create(name="A Group of A School")
+        Relationship.objects.create(tail_id=school.pk, head_id=group.pk, relationshiptype=rel_type)
+        with self.assertNumQueries(1):
+            self.assertEqual([org.name for org in Organisation.get_tops()], ["University of Adelaide"])
+        school = Organisation.objects.get(pk=school.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(school.has_children())
+        Relationship.objects.get(tail_id=1, head_id=school.pk).delete()
+        self.assertEqual(list(Organisation.get_tops()), [school])
+        self.assertFalse(Organisation.objects.get(pk=1).has_children())
+
+    def test_save_keeps_flags(self):
+        RelationshipType.objects.create(name='Organisation', entity_tail='organisation', entity_head='organisation')
+        uofa = Organisation.objects.get(name="University of Adelaide")
+        school = Organisation.objects.create(name="A School of University of Adelaide")
+        Relationship.objects.create(tail_id=uofa.pk, head_id=school.pk, relationshiptype='Organisation')
+        # Both instances were loaded before the relationship was created
+        uofa.name = 'The University of Adelaide'
+        uofa.save()
+        school.save()
+        uofa = Organisation.objects.get(pk=uofa.pk)
+        self.assertEqual((uofa.name, uofa.is_parent, uofa.is_child), ('The University of Adelaide', True, False))
+        self.assertTrue(Organisation.objects.get(pk=school.pk).is_child)
+
+    def test_save_inserts_missing_row(self):
+        uofa = Organisation.objects.get(name="University of Adelaide")
+        Organisation.objects.filter(pk=uofa.pk).delete()
+        uofa.save()
+        self.assertEqual(Organisation.objects.get(pk=uofa.pk).name, 'University of Adelaide')
+        Organisation(pk=uofa.pk + 1, name='A School of University of Adelaide').save()
+        self.assertTrue(Organisation.objects.filter(pk=uofa.pk + 1).exists())
+
+    def test_save_deferred_keeps_fields(self):
+        uofa = Organisation.objects.only('name').get(name="University of Adelaide")
+        uofa.name = 'The University of Adelaide'
+        with self.assertNumQueries(1):
+            uofa.save()
+        self.assertEqual(Organisation.objects.get(pk=uofa.pk).name, 'The University of Adelaide')
+
     def test_get_root(self):
         RelationshipType.objects.create(
             name='Organisation',
@@ -51,11 +93,175 @@ class OrganisationTestCase(TestCase):
             org_tail = org_head
         self.assertEqual(org_head.get_root_id(), 1)
 
+    def test_closure_follows_relationships(self):
+        from bman.models.organisation import get_child_ids_of, get_parent_ids_of
+        RelationshipType.objects.create(
+            name='Organisation',
+            entity_tail='organisation',
+            entity_head='organisation',
+            forward='is the parent organisation of',
+            backward='is a sub-organisation of')
+
+        # uofa -> school -> (group a, group b), uofa -> faculty
+        uofa = Organisation.objects.get(name="University of Adelaide")
+        school, group_a, group_b, faculty = [Organisation.objects.create(name=name) for name in
+                                             ('School', 'Group A', 'Group B', 'Faculty')]
+        for tail, head in ((uofa, school), (school, group_a), (school, group_b), (uofa, faculty)):
+            Relationship.objects.create(tail_id=tail.pk, head_id=head.pk, relationshiptype='Organisation')
+
+        for org in (uofa, school, group_a, faculty):
+            self.assertEqual(org.get_child_ids(), get_child_ids_of(org.pk))
+            self.assertEqual(org.get_parent_ids(), get_parent_ids_of(org.pk))
+        self.assertEqual(group_b.get_root_id(), uofa.pk)
+        self.assertEqual(len(uofa.get_children(flatten=True)), 4)
+
+        Relationship.objects.get(tail_id=uofa.pk, head_id=school.pk).delete()
+        self.assertEqual(group_a.get_root_id(), school.pk)
+        self.assertEqual(uofa.get_child_ids(), {str(faculty.pk): {}})
+
+        pairs = set(OrganisationClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        self.assertEqual(OrganisationClosure.rebuild(), len(pairs))
+        self.assertEqual(set(OrganisationClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')), pairs)
+
+    def test_closure_follows_edits(self):
+        organisation = RelationshipType.objects.create(
+            name='Organisation', entity_tail='organisation', entity_head='organisation')
+        other = RelationshipType.objects.create(name='Partner', entity_tail='organisation', entity_head='organisation')
+        uofa = Organisation.objects.get(name="University of Adelaide")
+        school, faculty = [Organisation.objects.create(name=name) for name in ('School', 'Faculty')]
+        for tail, head in ((uofa, school), (uofa, faculty)):
+            Relationship.objects.create(tail_id=tail.pk, head_id=head.pk, relationshiptype=organisation)
+
+        def closure():
+            return set(OrganisationClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+
+        # Moved: the edge is unlinked and linked, the table is not rebuilt
+        edge = Relationship.objects.get(head_id=school.pk)
+        edge.tail_id = faculty.pk
+        with patch.object(OrganisationClosure, 'rebuild') as rebuild:
+            edge.save()
+        self.assertFalse(rebuild.called)
+        self.assertEqual(closure(), {(uofa.pk, faculty.pk, 1), (faculty.pk, school.pk, 1), (uofa.pk, school.pk, 2)})
+        # No longer an edge of the hierarchy
+        edge.relationshiptype = other
+        edge.save()
+        self.assertEqual(closure(), {(uofa.pk, faculty.pk, 1)})
+        self.assertFalse(Organisation.objects.get(pk=school.pk).is_child)
+        self.assertFalse(Organisation.objects.get(pk=faculty.pk).is_parent)
+        # Other fields do not touch the table, only the type is read and the edge updated
+        edge = Relationship.objects.get(head_id=faculty.pk)
+        edge.direction = 'B'
+        with self.assertNumQueries(2):
+            edge.save()
+        edge = Relationship.objects.get(head_id=school.pk)
+        edge.relationshiptype = organisation
+        edge.save()
+        self.assertEqual(closure(), {(uofa.pk, faculty.pk, 1), (faculty.pk, school.pk, 1), (uofa.pk, school.pk, 2)})
+
+    def test_batch_ancestors(self):
+        from bman.models.organisation import get_ancestor_paths_of
+        RelationshipType.objects.create(name='Organisation', entity_tail='organisation', entity_head='organisation')
+        # uofa -> school -> (group a, group b), uofa -> faculty
+        uofa = Organisation.objects.get(name="University of Adelaide")
+        school, group_a, group_b, faculty, alone = [Organisation.objects.create(name=name) for name in
+                                                    ('School', 'Group A', 'Group B', 'Faculty', 'Alone')]
+        for tail, head in ((uofa, school), (school, group_a), (school, group_b), (uofa, faculty)):
+            Relationship.objects.create(tail_id=tail.pk, head_id=head.pk, relationshiptype='Organisation')
+
+        ids = [group_a.pk, group_b.pk, faculty.pk, alone.pk]
+        # One query per depth: the ids, then school and uofa together
+        with self.assertNumQueries(2):
+            paths = get_ancestor_paths_of(ids)
+        for org_id in ids:
+            self.assertEqual(paths[org_id], Organisation.objects.get(pk=org_id).get_parent_ids())
+        self.assertEqual(Organisation.get_root_ids('%d;%d' % (group_a.pk, alone.pk)),
+                         {group_a.pk: uofa.pk, alone.pk: alone.pk})
+        self.assertEqual(Organisation.get_ancestor_paths([group_a.pk], max_depth='1'), {group_a.pk: [school.pk]})
+
+    def test_batch_ancestors_with_cycle(self):
+        from bman.models.organisation import get_ancestor_paths_of, get_root_ids_of
+        rel_type = RelationshipType.objects.create(name='Loop', entity_tail='organisation', entity_head='organisation')
+        a, b, c = [Organisation.objects.create(name=name) for name in 'ABC']
+        for tail, head in ((a, b), (b, c), (c, a)):
+            Relationship.objects.create(tail_id=tail.pk, head_id=head.pk, relationshiptype=rel_type)
+        self.assertEqual(get_ancestor_paths_of([c.pk], rel_type), {c.pk: [b.pk, a.pk]})
+        self.assertEqual(get_root_ids_of([a.pk, c.pk], rel_type), {a.pk: b.pk, c.pk: a.pk})
+
+    def test_child_ids_of_shared_child(self):
+        from bman.models.organisation import get_child_ids_of
+        rel_type = RelationshipType.objects.create(name='Loop', entity_tail='organisation', entity_head='organisation')
+        a, b, c, d = [Organisation.objects.create(name=name) for name in 'ABCD']
+        for tail, head in ((a, b), (a, c), (b, d), (c, d), (d, b)):
+            Relationship.objects.create(tail_id=tail.pk, head_id=head.pk, relationshiptype=rel_type)
+        # d is under both of its parents, the edge from d back to b is left out
+        self.assertEqual(get_child_ids_of(a.pk, rel_type),
+                         {str(b.pk): {str(d.pk): {}}, str(c.pk): {str(d.pk): {}}})
+
+    def test_get_tree(self):
+        from bman.models.organisation import get_child_ids_of, get_tree_leaves, flat_ids
+        RelationshipType.objects.create(
+            name='Organisation',
+            entity_tail='organisation',
+            entity_head='organisation',
+            forward='is the parent organisation of',
+            backward='is a sub-organisation of')
+
+        orgs = [Organisation.objects.get(name="University of Adelaide")]
+        for i in range(1, 20):
+            orgs.append(Organisation.objects.create(name='Org %d' % i))
+            Relationship.objects.create(tail_id=orgs[(i - 1) // 3].pk, head_id=orgs[i].pk, relationshiptype='Organisation')
+
+        expected = get_tree_leaves(get_child_ids_of(orgs[0].pk), Organisation.objects.get)
+        with self.assertNumQueries(2):
+            tree = orgs[0].get_tree()
+        self.assertEqual(tree, expected)
+        self.assertEqual(list(tree.keys()), list(expected.keys()))
+        self.assertEqual(orgs[-1].get_tree(), {})
+
+        with self.assertNumQueries(2):
+            flattened = orgs[0].get_children(flatten=True, fields=['name'])
+        self.assertEqual([str(org.pk) for org in flattened],
+                         flat_ids(get_child_ids_of(orgs[0].pk), []))
+        with self.assertNumQueries(2):
+            self.assertEqual(orgs[0].children, orgs[1:4])
+
     def test_get_billing_organisations(self):
         # Only test if it is callable with no account informaion
         billers = Organisation.get_billing_organisations()
         self.assertEqual(len(billers), 0)
 
+    def test_get_billing_organisations_cached(self):
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        uofa = Organisation.objects.get(name='University of Adelaide')
+        other = Organisation.objects.create(name='eResearch SA')
+        person = Person.objects.create(first_name='John', last_name='Smith')
+        role = Role.objects.create(person=person, organisation=uofa, relationshiptype=rel_type)
+        account = Account.objects.create(role=role, username='john')
+        # one query with a subquery, then none until billing organisations change
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Organisation.get_billing_organisations()), [])
+        account = Account.objects.get(pk=account.pk)
+        account.billing_org = uofa
+        account.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Organisation.get_billing_organisations()), [uofa])
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Organisation.get_billing_organisations()), [uofa])
+        # Saves which do not change billing organisations keep the cache
+        account = Account.objects.get(pk=account.pk)
+        account.status = 'T'
+        account.save()
+        with self.assertNumQueries(0):
+            list(Organisation.get_billing_organisations())
+        account.billing_org = other
+        account.save()
+        self.assertEqual(list(Organisation.get_billing_organisations()), [other])
+        other.name = 'eRSA'
+        other.save()
+        self.assertEqual(Organisation.get_billing_organisations()[0].name, 'eRSA')
+        account.delete()
+        self.assertEqual(list(Organisation.get_billing_organisations()), [])
+
 
 class RelationshipTypeTestCase(TestCase):
     def test_validations(self):
@@ -79,6 +285,59 @@ class RelationshipTypeTestCase(TestCase):
             self.assertRaises(ValidationError, r.full_clean)
 
 
+class RegistryTestCase(TestCase):
+    fixtures = ['catalog.json', 'relationshiptype.json']
+
+    def test_lookups_are_cached(self):
+        from bman.models.registry import relationship_types, catalogs
+        relationship_types.get('Organisation')
+        with self.assertNumQueries(0):
+            organisation = relationship_types.get('Organisation')
+            self.assertEqual(relationship_types.get_by_pk(organisation.pk), organisation)
+            self.assertEqual(Relationship._ensure_type('Supervision').entity_tail, 'role')
+        self.assertEqual(catalogs.get('HPC').pk, 1)
+        self.assertRaises(RelationshipType.DoesNotExist, relationship_types.get, 'NotExist')
+
+    def test_misses_are_cached(self):
+        from bman.models.registry import relationship_types
+        # Tests run in a transaction, misses are only remembered outside them
+        with patch.object(connection, 'in_atomic_block', False):
+            self.assertRaises(RelationshipType.DoesNotExist, relationship_types.get, 'NotExist')
+            with self.assertNumQueries(0):
+                self.assertRaises(RelationshipType.DoesNotExist, relationship_types.get, 'NotExist')
+            self.assertRaises(RelationshipType.DoesNotExist, relationship_types.get_by_pk, 10000)
+            with self.assertNumQueries(0):
+                self.assertRaises(RelationshipType.DoesNotExist, relationship_types.get_by_pk, 10000)
+        RelationshipType.objects.create(name='NotExist', entity_tail='person', entity_head='person')
+        self.assertEqual(relationship_types.get('NotExist').entity_tail, 'person')
+
+    def test_misses_in_transactions_are_not_cached(self):
+        from bman.models.registry import relationship_types
+        self.assertRaises(RelationshipType.DoesNotExist, relationship_types.get, 'NotExist')
+        with self.assertNumQueries(1):
+            self.assertRaises(RelationshipType.DoesNotExist, relationship_types.get, 'NotExist')
+
+    def test_rolled_back_rows_are_dropped(self):
+        from bman.models.registry import relationship_types
+        try:
+            with transaction.atomic():
+                RelationshipType.objects.create(name='RolledBack', entity_tail='person', entity_head='person')
+                self.assertEqual(relationship_types.get('RolledBack').entity_tail, 'person')
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertRaises(RelationshipType.DoesNotExist, relationship_types.get, 'RolledBack')
+
+    def test_invalidated_by_changes(self):
+        from bman.models.registry import relationship_types
+        employment = relationship_types.get('Employment')
+        RelationshipType.objects.filter(pk=employment.pk).update(forward='hires')
+        self.assertEqual(relationship_types.get('Employment').forward, employment.forward)
+        employment = RelationshipType.objects.get(pk=employment.pk)
+        employment.save()
+        self.assertEqual(relationship_types.get('Employment').forward, 'hires')
+
+
 class RoleTestCase(TestCase):
     def setUp(self):
         RelationshipType.objects.create(
@@ -139,6 +398,41 @@ class RoleTestCase(TestCase):
             org_tail = Organisation.objects.get(name='Org level %d' % l)
             self.assertEqual(len(org_tail.get_all_roles()), last_level - l)
 
+        org_tail = Organisation.objects.get(id=1)
+        with self.assertNumQueries(2):
+            roles = org_tail.get_all_roles()
+            self.assertEqual(len([role.person.full_name for role in roles]), last_level + 1)
+        self.assertEqual([role.organisation.name for role in roles],
+                         ['University of Adelaide'] + ['Org level %d' % l for l in range(last_level)])
+        self.assertEqual(len(org_tail.get_all_roles(rel_type='Employment')), last_level + 1)
+        self.assertEqual(len(org_tail.get_all_roles(rel_type='Study')), 0)
+
+    def test_extended_accounts(self):
+        employment = RelationshipType.objects.get(name='Employment')
+        org = Organisation.objects.get(id=1)
+        for username, status in (('active', 'A'), ('terminated', 'T')):
+            role = Role.objects.create(person_id=1, organisation=org, relationshiptype=employment,
+                                       email='%s@example.com' % username)
+            Account.objects.create(role=role, username=username, billing_org=org, status=status)
+        with self.assertNumQueries(1):
+            extended = org.get_extended_accounts()
+        self.assertEqual(extended['active'], dict(role_id=Account.objects.get(username='active').role_id,
+                                                  fullname='John Smith', organisation='University of Adelaide',
+                                                  email='active@example.com'))
+        self.assertEqual(list(org.get_extended_accounts(status='A').keys()), ['active'])
+
+    def test_all_roles_in_period(self):
+        import datetime
+        employment = RelationshipType.objects.get(name='Employment')
+        org = Organisation.objects.get(id=1)
+        for start, end in ((None, None), (datetime.date(2010, 1, 1), datetime.date(2012, 12, 31)),
+                           (datetime.date(2015, 1, 1), None)):
+            Role.objects.create(person_id=1, organisation=org, relationshiptype=employment,
+                                start_date=start, end_date=end)
+        self.assertEqual(len(org.get_all_roles(start='2013-01-01')), 2)
+        self.assertEqual(len(org.get_all_roles(end='2011-01-01')), 2)
+        self.assertEqual(len(org.get_all_roles(start='2011-01-01', end='2016-01-01')), 3)
+
 
 class RelationshipTestCase(TestCase):
     def test_role_creation(self):
@@ -158,6 +452,49 @@ class RelationshipTestCase(TestCase):
         role2 = Relationship.objects.create(tail_id=o.pk, head_id=p.pk, relationshiptype='Employment')
         self.assertEqual(str(role2), 'University of Adelaide manages Dr John Smith')
 
+    def test_attach_ends(self):
+        RelationshipType.objects.create(
+            name='Employment',
+            entity_tail='organisation',
+            entity_head='person',
+            forward='manages',
+            backward='works for')
+        o = Organisation.objects.create(name='University of Adelaide')
+        for i in range(5):
+            p = Person.objects.create(first_name='John%d' % i, last_name='Smith')
+            Relationship.objects.create(tail_id=o.pk, head_id=p.pk, relationshiptype='Employment')
+
+        # relationships, organisations and persons
+        with self.assertNumQueries(3):
+            names = [str(rel) for rel in Relationship.objects.all().with_ends()]
+        self.assertEqual(names[0], 'University of Adelaide manages John0 Smith')
+        self.assertEqual(names, [str(rel) for rel in Relationship.objects.all()])
+        self.assertEqual(Relationship.objects.with_ends().filter(head_id=p.pk).get().head, p)
+
+    def test_bulk_link(self):
+        from bman.models.relationship import TAIL_CONSTRAINT_ERROR, SELF_POINTING_ERROR, EXISTS_ERROR
+        RelationshipType.objects.create(
+            name='Organisation',
+            entity_tail='organisation',
+            entity_head='organisation',
+            forward='is the parent organisation of',
+            backward='is a sub-organisation of',
+            tconstraint=True)
+        orgs = [Organisation.objects.create(name='Org %d' % i) for i in range(5)]
+        Relationship.objects.create(tail_id=orgs[0].pk, head_id=orgs[1].pk, relationshiptype='Organisation')
+
+        edges = [dict(relationshiptype='Organisation', tail_id=tail.pk, head_id=head.pk)
+                 for tail, head in ((orgs[0], orgs[1]), (orgs[1], orgs[2]), (orgs[2], orgs[2]),
+                                    (orgs[0], orgs[2]), (orgs[2], orgs[3]), (orgs[3], orgs[4]))]
+        # in a savepoint: lock of the type, existing edges, insertion, rebuild of closure
+        # (five queries) and roots of service ownership (three queries)
+        with self.assertNumQueries(14):
+            created, rejected = Relationship.objects.bulk_link(edges)
+        self.assertEqual(len(created), 3)
+        self.assertEqual([reason for _, reason in rejected], [EXISTS_ERROR, SELF_POINTING_ERROR, TAIL_CONSTRAINT_ERROR])
+        self.assertEqual(Relationship.objects.count(), 4)
+        self.assertEqual(Organisation.objects.get(pk=orgs[4].pk).get_parent_ids(), [org.pk for org in reversed(orgs[:4])])
+
     def test_get_parents(self):
         from bman.models.organisation import get_parent_ids_of
 
@@ -191,6 +528,18 @@ class RelationshipTestCase(TestCase):
 #        print(e)
 
 
+class EventTestCase(TestCase):
+    def test_str_reads_type_from_registry(self):
+        from bman.models import Event, EventType
+        john = Person.objects.create(first_name="John", last_name="Smith")
+        event_type = EventType.objects.create(name='create', entity='person')
+        event = Event.objects.get(pk=Event.objects.create(type=event_type, entity_id=john.pk).pk)
+        str(event)
+        # Only the entity is queried once the type is loaded
+        with self.assertNumQueries(1):
+            self.assertTrue(str(event).endswith('create John Smith'))
+
+
 class ServiceTestCase(TestCase):
     fixtures = ['catalog.json']
 
@@ -212,6 +561,29 @@ class ServiceTestCase(TestCase):
         uofa = Organisation.objects.get(name="University of Adelaide")
         self.assertTrue(len(uofa.get_all_services()) > 0)
 
+    def test_organisation_services_in_subtree(self):
+        RelationshipType.objects.create(name='Organisation', entity_tail='organisation', entity_head='organisation')
+        uofa = Organisation.objects.get(name="University of Adelaide")
+        school = Organisation.objects.create(name='School')
+        Relationship.objects.create(tail_id=uofa.pk, head_id=school.pk, relationshiptype='Organisation')
+        for username in ('first', 'second'):
+            person = Person.objects.create(first_name=username, last_name='Smith')
+            role = Role.objects.create(person=person, organisation=school, relationshiptype_id=1)
+            Account.objects.create(role=role, username=username, billing_org=school)
+            RDS.objects.create(contractor=role, allocation_num=username, collection_name='data')
+
+        # One query per service type, however many accounts
+        with self.assertNumQueries(3):
+            services = uofa.get_all_services(subtree=True)
+            self.assertEqual([service.to_dict()['billing'] for service in services],
+                             ['University of Adelaide', 'School', 'School'])
+        self.assertEqual(len(uofa.get_all_services()), 1)
+        # a list of services per account
+        self.assertEqual([[service.allocation_num for service in services] for services in school.get_service('rds')],
+                         [['first'], ['second']])
+        self.assertEqual(len(uofa.get_service('RDS', subtree='true')), 2)
+        self.assertEqual(list(uofa.iter_services(subtree=True)), services)
+
     def test_person_services(self):
         p = Person.objects.get(first_name='John', last_name='Smith')
         self.assertTrue(len(p.get_all_services()) > 0)
@@ -227,9 +599,447 @@ class ServiceTestCase(TestCase):
         self.assertIsInstance(p.get_service('AccessService')[0], AccessService)
         self.assertEqual(len(p.get_service('NotExist')), 0)
 
+    def test_service_types(self):
+        from bman.models.service import get_service_types
+        self.assertEqual(get_service_types(), [AccessService, RDS, Nectar])
+
+    def test_services_of_roles(self):
+        from bman.models.service import get_services_of
+        role = Role.objects.get(person_id=1)
+        other = Role.objects.create(person_id=1, organisation_id=1, relationshiptype=role.relationshiptype)
+        RDS.objects.create(contractor=role, allocation_num='1', collection_name='data')
+        Nectar.objects.create(contractor=other, openstack_id='abc')
+        # One query per service type, names shown without more queries
+        with self.assertNumQueries(3):
+            grouped = get_services_of(roles=[role, other.pk])
+            names = {role_id: [str(service) for service in services] for role_id, services in grouped.items()}
+        self.assertEqual([type(service) for service in grouped[role.pk]], [AccessService, RDS])
+        self.assertEqual(len(names[other.pk]), 1)
+        self.assertEqual(get_services_of(persons=[1]).keys(), grouped.keys())
+        self.assertEqual(Person.objects.get(pk=1).get_all_services(), grouped[role.pk] + grouped[other.pk])
+        self.assertEqual(role.get_all_services(), grouped[role.pk])
+        self.assertRaises(ValueError, get_services_of)
+
+    def test_services_to_dicts(self):
+        uofa = Organisation.objects.get(name="University of Adelaide")
+        role = Role.objects.get(person_id=1)
+        p = Person.objects.create(first_name='Matt', last_name='Smith')
+        no_account = Role.objects.create(person=p, organisation=uofa, relationshiptype=role.relationshiptype)
+        for i, contractor in enumerate((role, no_account, role)):
+            RDS.objects.create(contractor=contractor, allocation_num=str(i), collection_name='data')
+        expected = [service.to_dict() for service in RDS.objects.all()]
+        with self.assertNumQueries(1):
+            self.assertEqual(RDS.to_dicts(RDS.objects.all()), expected)
+        with self.assertNumQueries(1):
+            AccessService.to_dicts(AccessService.objects.filter(contractor=no_account))
+
     def test_billing_organisation_without_account(self):
         uofa = Organisation.objects.get(name="University of Adelaide")
         p = Person.objects.create(first_name='Matt', last_name='Smith', title='Dr')
         role = Role.objects.create(person=p, organisation=uofa, relationshiptype=RelationshipType.objects.get(name='Employment'))
         service = AccessService.objects.create(catalog=Catalog.objects.get(pk=1), contractor=role)
         self.assertIsInstance(service.billing_organisation, Organisation)
+
+
+class ServiceOwnershipTestCase(TestCase):
+    fixtures = ['catalog.json']
+
+    def setUp(self):
+        for name, tail, head in (('Organisation', 'organisation', 'organisation'),
+                                 ('Employment', 'organisation', 'person')):
+            RelationshipType.objects.create(name=name, entity_tail=tail, entity_head=head)
+        self.uofa = Organisation.objects.create(name='University of Adelaide')
+        self.school = Organisation.objects.create(name='School')
+        person = Person.objects.create(first_name='John', last_name='Smith')
+        self.role = Role.objects.create(person=person, organisation=self.school,
+                                        relationshiptype=RelationshipType.objects.get(name='Employment'))
+        self.rds = RDS.objects.create(contractor=self.role, allocation_num='RDS-1', collection_name='data')
+        AccessService.objects.create(contractor=self.role, catalog=Catalog.objects.get(pk=1))
+
+    def rows(self):
+        return sorted((row.service_type, row.identifier, row.billing_org_id, row.organisation_id, row.root_id)
+                      for row in ServiceOwnership.objects.all())
+
+    def test_kept_in_sync(self):
+        catalog = Catalog.objects.get(pk=1).name
+        self.assertEqual(self.rows(), [('AccessService', catalog, self.school.pk, self.school.pk, self.school.pk),
+                                       ('RDS', 'RDS-1', self.school.pk, self.school.pk, self.school.pk)])
+        Relationship.objects.create(tail_id=self.uofa.pk, head_id=self.school.pk, relationshiptype='Organisation')
+        account = Account.objects.create(role=self.role, username='john', billing_org=self.uofa)
+        self.assertEqual({row[2:] for row in self.rows()}, {(self.uofa.pk, self.school.pk, self.uofa.pk)})
+
+        self.rds.allocation_num = 'RDS-2'
+        self.rds.save()
+        self.assertIn('RDS-2', [row[1] for row in self.rows()])
+        account.delete()
+        Relationship.objects.get(head_id=self.school.pk).delete()
+        self.assertEqual({row[2:] for row in self.rows()}, {(self.school.pk, self.school.pk, self.school.pk)})
+        self.rds.delete()
+        self.assertEqual([row[0] for row in self.rows()], ['AccessService'])
+
+        rows = self.rows()
+        self.assertEqual(ServiceOwnership.rebuild(), 1)
+        self.assertEqual(self.rows(), rows)
+
+    def test_refresh_all_roots(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        Relationship.objects.create(tail_id=self.uofa.pk, head_id=self.school.pk, relationshiptype='Organisation')
+        ServiceOwnership.objects.update(root_id=0)
+        with CaptureQueriesContext(connection) as queries:
+            ServiceOwnership.refresh_roots()
+        self.assertEqual({row[4] for row in self.rows()}, {self.uofa.pk})
+        # organisations without ancestors are excluded by a subquery of the closure
+        self.assertIn('bman_organisationclosure', queries[1]['sql'])
+
+    def test_search_and_summarise(self):
+        Relationship.objects.create(tail_id=self.uofa.pk, head_id=self.school.pk, relationshiptype='Organisation')
+        with self.assertNumQueries(1):
+            self.assertEqual(ServiceOwnership.summarise('root_id', status='E'), [
+                {'root_id': self.uofa.pk, 'service_type': 'AccessService', 'count': 1},
+                {'root_id': self.uofa.pk, 'service_type': 'RDS', 'count': 1}])
+        self.assertEqual(ServiceOwnership.search(root_id=self.uofa.pk, service_type='RDS').get().service_id,
+                         self.rds.pk)
+        self.assertRaises(ValueError, ServiceOwnership.search, username='john')
+        self.assertRaises(ValueError, ServiceOwnership.summarise, 'identifier')
+
+
+class RDSCapacityTestCase(TestCase):
+    def setUp(self):
+        for name, tail, head in (('Organisation', 'organisation', 'organisation'),
+                                 ('Employment', 'organisation', 'person')):
+            RelationshipType.objects.create(name=name, entity_tail=tail, entity_head=head)
+        employment = RelationshipType.objects.get(name='Employment')
+        self.uofa, self.school, self.group = [Organisation.objects.create(name=name)
+                                              for name in ('University of Adelaide', 'School', 'Group')]
+        Relationship.objects.create(tail_id=self.uofa.pk, head_id=self.school.pk, relationshiptype='Organisation')
+        Relationship.objects.create(tail_id=self.school.pk, head_id=self.group.pk, relationshiptype='Organisation')
+        person = Person.objects.create(first_name='John', last_name='Smith')
+        # group pays 10 and 20 for RDS of a role at group, uofa pays 30 of a role at school
+        self.roles = [Role.objects.create(person=person, organisation=org, relationshiptype=employment)
+                      for org in (self.group, self.school)]
+        Account.objects.create(role=self.roles[1], username='john', billing_org=self.uofa)
+        for role, size in ((self.roles[0], 10), (self.roles[0], 20), (self.roles[1], 30)):
+            RDS.objects.create(contractor=role, allocation_num=str(size), collection_name='data', approved_size=size)
+
+    def test_groups(self):
+        with self.assertNumQueries(2):
+            capacity = RDS.get_capacity()
+        self.assertEqual(capacity, {str(self.group.pk): dict(name='Group', count=2, size=30),
+                                    str(self.uofa.pk): dict(name='University of Adelaide', count=1, size=30)})
+        with self.assertNumQueries(0):
+            self.assertEqual(RDS.get_capacity(), capacity)
+        self.assertEqual(RDS.get_capacity('root'), {str(self.uofa.pk): dict(name='University of Adelaide', count=3, size=60)})
+        by_organisation = RDS.get_capacity('organisation', subtree='true')
+        self.assertEqual({key: value['size'] for key, value in by_organisation.items()},
+                         {str(self.group.pk): 30, str(self.school.pk): 60, str(self.uofa.pk): 60})
+        by_organisation = RDS.get_capacity('organisation', top_id=str(self.school.pk), subtree=True)
+        self.assertEqual({key: value['size'] for key, value in by_organisation.items()},
+                         {str(self.group.pk): 30, str(self.school.pk): 60})
+        self.assertRaises(ValueError, RDS.get_capacity, 'person')
+
+    def test_invalidated(self):
+        self.assertEqual(RDS.get_capacity('organisation')[str(self.school.pk)]['size'], 30)
+        RDS.objects.create(contractor=self.roles[1], allocation_num='5', collection_name='data', approved_size=5)
+        self.assertEqual(RDS.get_capacity('organisation')[str(self.school.pk)]['size'], 35)
+        Account.objects.get(username='john').delete()
+        self.assertEqual(RDS.get_capacity()[str(self.school.pk)]['size'], 35)
+
+
+class OrganisationResolveTestCase(TestCase):
+    def setUp(self):
+        self.uofa = Organisation.objects.create(name='University of  Adelaide')
+
+    def test_normalised(self):
+        self.assertEqual(self.uofa.normalised_name, 'university of adelaide')
+        self.uofa.name = 'The University of Adelaide'
+        self.uofa.save()
+        self.assertEqual(Organisation.objects.get(pk=self.uofa.pk).normalised_name, 'the university of adelaide')
+        Organisation.objects.filter(pk=self.uofa.pk).update(normalised_name='')
+        self.assertEqual(Organisation.objects.normalise_names(), 1)
+        self.assertEqual(Organisation.objects.normalise_names(), 0)
+
+    def test_resolve(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(Organisation.objects.resolve(' UNIVERSITY of adelaide\t'), self.uofa)
+        self.assertIsNone(Organisation.objects.resolve('  '))
+        self.assertRaises(Organisation.DoesNotExist, Organisation.objects.resolve, 'eResearch SA', create=False)
+        created = Organisation.objects.resolve(' eResearch  SA ')
+        self.assertEqual(created.name, 'eResearch SA')
+        self.assertEqual(Organisation.objects.resolve('ERESEARCH SA'), created)
+        self.assertEqual(Organisation.objects.count(), 2)
+
+    def test_resolve_renamed(self):
+        with Organisation.objects.memoised():
+            Organisation.objects.resolve('University of Adelaide')
+            self.uofa.name = 'Adelaide University'
+            self.uofa.save()
+            self.assertNotEqual(Organisation.objects.resolve('University of Adelaide'), self.uofa)
+            self.assertEqual(Organisation.objects.resolve('adelaide university'), self.uofa)
+
+    def test_memoised(self):
+        from django.db import transaction
+        from bman.models.organisation import OrganisationManager
+        with Organisation.objects.memoised():
+            Organisation.objects.resolve('University of Adelaide')
+            with self.assertNumQueries(0):
+                self.assertEqual(Organisation.objects.resolve('university of adelaide'), self.uofa)
+        # only within memoised(), e.g. a run of a command
+        with self.assertNumQueries(1):
+            Organisation.objects.resolve('university of adelaide')
+        self.assertIsNone(OrganisationManager._local.memo)
+        # Not within transactions, which could be rolled back
+        with Organisation.objects.memoised():
+            with transaction.atomic():
+                Organisation.objects.resolve('eResearch SA')
+            self.assertEqual(OrganisationManager._local.memo, {})
+
+    def test_resolve_created_meanwhile(self):
+        # Another process commits the same name after the lookup missed
+        other = Organisation.objects.create(name='eResearch SA')
+        with patch('django.db.models.query.QuerySet.first', side_effect=[None, other]):
+            self.assertEqual(Organisation.objects.resolve('eresearch sa'), other)
+        self.assertEqual(Organisation.objects.filter(normalised_name='eresearch sa').count(), 1)
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.john = Person.objects.create(first_name='John', last_name='Smith')
+        self.smithers = Person.objects.create(first_name='Waylon', last_name='Smithers')
+        self.jo = Person.objects.create(first_name='Jo', last_name='Johnson')
+        self.uofa = Organisation.objects.create(name='University of Adelaide', abbreviation='UofA')
+        self.eresearch = Organisation.objects.create(name='eResearch SA', abbreviation='eRSA')
+
+    def found(self, q, entity=None):
+        from bman.models.search import search
+        return [(result['entity'], result['id']) for result in search(q, entity)]
+
+    def test_ranked(self):
+        from bman.models.search import search
+        # exact last name, then prefix of last name
+        self.assertEqual(self.found('smith'), [('person', self.john.pk), ('person', self.smithers.pk)])
+        self.assertEqual(self.found('joh'), [('person', self.jo.pk), ('person', self.john.pk)])
+        self.assertEqual(self.found('joh smi'), [('person', self.john.pk)])
+        # short words are not prefixes, only whole words
+        self.assertEqual(self.found('jo'), [('person', self.jo.pk)])
+        self.assertEqual(self.found('jo smi'), [])
+        self.assertEqual(self.found('jo johnson'), [('person', self.jo.pk)])
+        self.assertEqual(self.found('s'), [])
+        self.assertEqual(self.found('ADEL'), [('organisation', self.uofa.pk)])
+        self.assertEqual(self.found('ersa'), [('organisation', self.eresearch.pk)])
+        self.assertEqual(self.found('smith', 'organisation'), [])
+        self.assertEqual(self.found('  '), [])
+        self.assertEqual(search('univ')[0]['name'], 'University of Adelaide')
+        self.assertRaises(ValueError, search, 'smith', 'role')
+        # a word per entity and a query to load results
+        with self.assertNumQueries(5):
+            search('joh smi')
+
+    def test_maintained(self):
+        self.john.last_name = 'Müller'
+        self.john.save()
+        self.assertEqual(self.found('muller'), [('person', self.john.pk)])
+        self.assertEqual(self.found('smith'), [('person', self.smithers.pk)])
+        self.smithers.delete()
+        self.assertEqual(self.found('smith'), [])
+        terms = set(SearchTerm.objects.values_list('term', 'entity', 'entity_id', 'weight'))
+        self.assertEqual(SearchTerm.rebuild(), len(terms))
+        self.assertEqual(set(SearchTerm.objects.values_list('term', 'entity', 'entity_id', 'weight')), terms)
+
+
+class RelationshipGraphTestCase(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        self.graph_dir = tempfile.TemporaryDirectory()
+        self.settings = override_settings(BMAN_GRAPH_DIR=self.graph_dir.name)
+        self.settings.enable()
+
+        RelationshipType.objects.create(
+            name='Organisation',
+            entity_tail='organisation',
+            entity_head='organisation',
+            forward='is the parent organisation of',
+            backward='is a sub-organisation of')
+        self.orgs = [Organisation.objects.create(name='Org %d' % i) for i in range(10)]
+        for i in range(1, 10):
+            Relationship.objects.create(tail_id=self.orgs[(i - 1) // 3].pk, head_id=self.orgs[i].pk,
+                                        relationshiptype='Organisation')
+
+    def tearDown(self):
+        self.settings.disable()
+        self.graph_dir.cleanup()
+
+    def test_lookups(self):
+        from bman.models.graph import get_graph
+        from bman.models.organisation import flat_ids
+        top = self.orgs[0]
+        graph = get_graph('Organisation')
+        # only the stamp of edges is read when the snapshot is current
+        with self.assertNumQueries(1):
+            graph = get_graph('Organisation')
+        with self.assertNumQueries(0):
+            self.assertEqual(graph.children(top.pk), [org.pk for org in self.orgs[1:4]])
+            self.assertEqual(graph.parents(self.orgs[4].pk), [self.orgs[1].pk])
+            self.assertEqual(graph.root(self.orgs[9].pk), top.pk)
+            self.assertEqual(graph.root(top.pk), top.pk)
+            self.assertEqual(graph.children(10000), [])
+        self.assertEqual(graph.subtree(top.pk), [int(i) for i in flat_ids(top.get_child_ids(), [])])
+        self.assertEqual(graph.ancestors(self.orgs[9].pk), self.orgs[9].get_parent_ids())
+
+    def test_stale_snapshot_is_rebuilt(self):
+        from bman.models.graph import get_graph
+        from bman.models.organisation import get_root_ids_of
+        graph = get_graph('Organisation')
+        new_org = Organisation.objects.create(name='New')
+        Relationship.objects.create(tail_id=self.orgs[9].pk, head_id=new_org.pk, relationshiptype='Organisation')
+        self.assertNotEqual(get_graph('Organisation').version, graph.version)
+        self.assertEqual(get_graph('Organisation').root(new_org.pk), self.orgs[0].pk)
+        self.assertEqual(get_root_ids_of([new_org.pk]), {new_org.pk: self.orgs[0].pk})
+
+    def test_changes_without_signals_are_found(self):
+        from bman.models.graph import get_graph
+        graph = get_graph('Organisation')
+        # e.g. by another process whose version was bumped before its transaction committed
+        Relationship.objects.filter(head_id=self.orgs[9].pk).update(tail_id=self.orgs[1].pk)
+        self.assertNotEqual(get_graph('Organisation').stamp, graph.stamp)
+        self.assertEqual(get_graph('Organisation').parents(self.orgs[9].pk), [self.orgs[1].pk])
+
+    def test_version_wraps(self):
+        from bman.models import graph
+        with open(graph._version_path(), 'w') as f:
+            f.write(str(graph.VERSION_MODULO - 1))
+        self.assertEqual(graph.bump_version(), 0)
+        self.assertEqual(graph.get_version(), 0)
+
+
+class RollupTestCase(TestCase):
+    fixtures = ['catalog.json']
+
+    def setUp(self):
+        from bman.models import RDS
+        RelationshipType.objects.create(
+            name='Organisation',
+            entity_tail='organisation',
+            entity_head='organisation',
+            forward='is the parent organisation of',
+            backward='is a sub-organisation of')
+        employment = RelationshipType.objects.create(
+            name='Employment',
+            entity_tail='organisation',
+            entity_head='person',
+            forward='manages',
+            backward='works for')
+        person = Person.objects.create(first_name='John', last_name='Smith')
+        # uofa -> school -> group
+        self.orgs = [Organisation.objects.create(name=name) for name in ('UofA', 'School', 'Group')]
+        for tail, head in zip(self.orgs, self.orgs[1:]):
+            Relationship.objects.create(tail_id=tail.pk, head_id=head.pk, relationshiptype='Organisation')
+        for i, org in enumerate(self.orgs):
+            role = Role.objects.create(person=person, organisation=org, relationshiptype=employment)
+            Account.objects.create(role=role, username='user%d' % i, billing_org=self.orgs[0],
+                                   status='A' if i else 'T')
+            RDS.objects.create(contractor=role, allocation_num='RDS%d' % i, approved_size=10 * (i + 1))
+        AccessService.objects.create(catalog=Catalog.objects.get(pk=1), contractor=role)
+
+    def test_rollup(self):
+        top, school, group = self.orgs
+        with self.assertNumQueries(8):
+            report = top.get_rollup()
+        self.assertEqual(list(report.keys()), [str(org.pk) for org in self.orgs])
+        self.assertEqual(report[str(group.pk)]['own'], report[str(group.pk)]['total'])
+        self.assertEqual(report[str(school.pk)]['parent_id'], top.pk)
+        self.assertEqual(report[str(top.pk)]['own'],
+                         dict(roles=1, accounts=0, accessservice=0, rds=1, nectar=0, rds_size=10))
+        self.assertEqual(report[str(top.pk)]['total'],
+                         dict(roles=3, accounts=2, accessservice=1, rds=3, nectar=0, rds_size=60))
+        self.assertEqual(report[str(school.pk)]['total']['rds_size'], 50)
+        self.assertEqual(Organisation.rollup(group.pk)[str(group.pk)]['total']['roles'], 1)
+
+    def test_rollup_roles_of_types(self):
+        top = self.orgs[0]
+        study = RelationshipType.objects.create(name='Study', entity_tail='organisation', entity_head='person')
+        employment = RelationshipType.objects.get(name='Employment')
+        person = Person.objects.get(first_name='John')
+        for rel_type in (employment, study, study):
+            Role.objects.create(person=person, organisation=top, relationshiptype=rel_type)
+        report = top.get_rollup()
+        self.assertEqual(report[str(top.pk)]['own']['roles'], 4)
+        self.assertEqual(report[str(top.pk)]['total']['roles'], 6)
+
+
+class TraversalTestCase(TestCase):
+    def setUp(self):
+        for name, tail, head in (('Organisation', 'organisation', 'organisation'),
+                                 ('Employment', 'organisation', 'person'),
+                                 ('Study', 'organisation', 'person'),
+                                 ('Supervision', 'role', 'role')):
+            RelationshipType.objects.create(name=name, entity_tail=tail, entity_head=head,
+                                            forward='forward', backward='backward')
+        self.org = Organisation.objects.create(name='University of Adelaide')
+        self.school = Organisation.objects.create(name='School')
+        Relationship.objects.create(tail_id=self.org.pk, head_id=self.school.pk, relationshiptype='Organisation')
+
+        # professor supervises lecturer who supervises student
+        self.roles = []
+        for first_name, rel_type in (('Professor', 'Employment'), ('Lecturer', 'Employment'), ('Student', 'Study')):
+            person = Person.objects.create(first_name=first_name, last_name='Smith')
+            self.roles.append(Role.objects.create(person=person, organisation=self.org,
+                                                  relationshiptype=RelationshipType.objects.get(name=rel_type)))
+        for tail, head in zip(self.roles, self.roles[1:]):
+            Relationship.objects.create(tail_id=tail.pk, head_id=head.pk, relationshiptype='Supervision')
+
+    def test_supervision_chain(self):
+        from bman.models.utils import traverse
+        professor, lecturer, student = self.roles
+        # three levels (the last finds nothing) and roles with persons
+        with self.assertNumQueries(4):
+            hops = traverse(professor, 'Supervision', depth=None, select_related={'role': ['person']})
+            self.assertEqual([(hop.depth, hop.target.person.first_name) for hop in hops],
+                             [(1, 'Lecturer'), (2, 'Student')])
+        hops = traverse(student, 'Supervision', 'backward', depth=1, hydrate=False)
+        self.assertEqual([hop.target_id for hop in hops], [lecturer.pk])
+        self.assertEqual([p.first_name for p in professor.get_students()], ['Lecturer'])
+        self.assertEqual([p.first_name for p in student.get_supervisors()], ['Lecturer'])
+
+        # a cycle ends the expansion
+        Relationship.objects.create(tail_id=student.pk, head_id=professor.pk, relationshiptype='Supervision')
+        self.assertEqual(len(traverse(professor, 'Supervision', depth=None, hydrate=False)), 2)
+
+    def test_batched_supervision(self):
+        professor, lecturer, student = self.roles
+        # links from employees, links to students, roles at the other ends
+        with self.assertNumQueries(3):
+            supervision = Role.get_supervision(self.roles)
+        self.assertEqual([p.first_name for p in supervision[professor.pk]['students']], ['Lecturer'])
+        self.assertEqual([p.first_name for p in supervision[lecturer.pk]['students']], ['Student'])
+        self.assertEqual(supervision[lecturer.pk]['supervisors'], [])
+        self.assertEqual([p.first_name for p in supervision[student.pk]['supervisors']], ['Lecturer'])
+        self.assertEqual(supervision[student.pk]['students'], [])
+        with self.assertNumQueries(0):
+            self.assertEqual(Role.get_supervision([]), {})
+
+    def test_shared_student(self):
+        from bman.models.utils import traverse
+        professor, lecturer, student = self.roles
+        Relationship.objects.create(tail_id=professor.pk, head_id=student.pk, relationshiptype='Supervision')
+        # start entities are visited, and the student is only reached once
+        hops = traverse([professor, lecturer], 'Supervision', hydrate=False)
+        self.assertEqual([(hop.source_id, hop.target_id) for hop in hops], [(lecturer.pk, student.pk)])
+        hops = traverse([professor, lecturer], 'Supervision', hydrate=False, per_source=True)
+        self.assertEqual([(hop.source_id, hop.target_id) for hop in hops],
+                         [(professor.pk, lecturer.pk), (lecturer.pk, student.pk), (professor.pk, student.pk)])
+        supervision = Role.get_supervision(self.roles)
+        self.assertEqual([p.first_name for p in supervision[professor.pk]['students']], ['Lecturer', 'Student'])
+        self.assertEqual([p.first_name for p in supervision[lecturer.pk]['students']], ['Student'])
+        self.assertEqual([p.first_name for p in supervision[student.pk]['supervisors']], ['Lecturer', 'Professor'])
+
+    def test_mixed_neighbourhood(self):
+        from bman.models.utils import traverse
+        person = Person.objects.create(first_name='Jane', last_name='Doe')
+        Relationship.objects.create(tail_id=self.org.pk, head_id=person.pk, relationshiptype='Employment')
+        with self.assertNumQueries(3):
+            hops = traverse(self.org, ['Organisation', 'Employment'])
+        self.assertEqual([hop.target for hop in hops], [self.school, person])
+        self.assertTrue(all(hop.source == self.org for hop in hops))
+        self.assertRaises(ValueError, traverse, self.org, direction='sideway')
@@ -0,0 +1,150 @@
+import re
+import unittest
+from unittest.mock import patch
+
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.test import TestCase
+
+from bman.models import (RelationshipType, Relationship, Person, Organisation, OrganisationClosure, Role,
+                         ServiceOwnership)
+from bman.models.organisation import get_ancestor_paths_of
+from bman.models.search import search, lookup
+from bman.models.utils import traverse, get_related
+
+# Tables of registries are read whole on purpose
+SMALL_TABLES = ('bman_relationshiptype', 'bman_catalog', 'bman_eventtype')
+
+
+def capture_selects(call):
+    """Run call and get a list of (sql, params) of SELECT statements it executed"""
+    executed = []
+    execute = CursorWrapper.execute
+
+    def recording_execute(cursor, sql, params=None):
+        executed.append((sql, params))
+        return execute(cursor, sql, params)
+
+    with patch.object(CursorWrapper, 'execute', recording_execute):
+        call()
+    return [(sql, params) for sql, params in executed if sql.lstrip().upper().startswith('SELECT')]
+
+
+def explain(sql, params):
+    """Get the plan of a statement as one string from the database"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+        # Test tables are tiny, planners only pick an index when sequential scans are off
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+class QueryPlanTestCase(TestCase):
+    """Queries which traversal and reporting methods run must be served by indexes on all
+    filtered columns, and must not be sorted unless they are listed as sorted"""
+
+    def setUp(self):
+        self.rel_type = RelationshipType.objects.create(
+            name='Organisation', entity_tail='organisation', entity_head='organisation')
+        employment = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        self.top = Organisation.objects.create(name='Top')
+        self.child = Organisation.objects.create(name='Child')
+        self.leaf = Organisation.objects.create(name='Leaf')
+        Relationship.objects.create(tail_id=self.top.pk, head_id=self.child.pk, relationshiptype=self.rel_type)
+        person = Person.objects.create(first_name='John', last_name='Smith')
+        Role.objects.create(person=person, organisation=self.child, relationshiptype=employment)
+
+    def calls(self):
+        """Get a list of (name, call, [(table, columns expected in one index search)], sorted)"""
+        by_type = ('relationshiptype_id', )
+        return [
+            ('traverse forward', lambda: traverse(self.top, self.rel_type, depth=None),
+             [('bman_relationship', by_type + ('tail_id', ))], False),
+            ('traverse backward', lambda: traverse(self.child, self.rel_type, 'backward', depth=None),
+             [('bman_relationship', by_type + ('head_id', ))], False),
+            ('get_related', lambda: get_related(self.top, 'Organisation'),
+             [('bman_relationship', by_type + ('head_id', )), ('bman_relationship', by_type + ('tail_id', ))], False),
+            # The stamp of the snapshot and its export read edges of a type
+            ('get_ancestor_paths_of', lambda: get_ancestor_paths_of([self.child.pk, self.leaf.pk]),
+             [('bman_relationship', by_type)], False),
+            ('get_child_ids', lambda: self.top.get_child_ids(),
+             [('bman_relationship', by_type + ('head_id', )), ('bman_organisationclosure', ('ancestor_id', ))], False),
+            # Role is ordered by relationshiptype
+            ('get_all_roles', lambda: self.top.get_all_roles(),
+             [('bman_role', ('organisation_id', )), ('bman_organisationclosure', ('ancestor_id', )),
+              ('bman_relationship', by_type + ('head_id', ))], True),
+            ('get_parent_ids', lambda: self.child.get_parent_ids(),
+             [('bman_organisationclosure', ('descendant_id', ))], False),
+            ('get_root_id', lambda: self.child.get_root_id(),
+             [('bman_organisationclosure', ('descendant_id', ))], False),
+            ('OrganisationClosure.get_roots', lambda: OrganisationClosure.get_roots([self.child.pk]),
+             [('bman_organisationclosure', ('descendant_id', ))], False),
+            ('OrganisationClosure.link', lambda: OrganisationClosure.link(self.child.pk, self.leaf.pk),
+             [('bman_organisationclosure', ('descendant_id', )), ('bman_organisationclosure', ('ancestor_id', )),
+              ('bman_organisationclosure', ('ancestor_id', 'descendant_id'))], False),
+            ('OrganisationClosure.unlink', lambda: OrganisationClosure.unlink(self.top.pk, self.child.pk),
+             [('bman_organisationclosure', ('descendant_id', )), ('bman_relationship', by_type + ('tail_id', )),
+              ('bman_relationship', by_type + ('head_id', ))], False),
+        ] + [
+            ('ServiceOwnership.search by %s' % column,
+             lambda column=column: list(ServiceOwnership.search(**{column: self.top.pk, 'service_type': 'RDS'})),
+             [('bman_serviceownership', (column, 'service_type'))], False)
+            for column in ('billing_org_id', 'root_id', 'organisation_id', 'person_id')
+        ] + [
+            ('search', lambda: search('smi', 'person'), [('bman_searchterm', ('entity', 'term'))], False),
+            ('lookup role', lambda: lookup('role', 'smi'),
+             [('bman_searchterm', ('entity', 'term')), ('bman_role', ('person_id', )),
+              ('bman_role', ('organisation_id', ))], False),
+        ]
+
+    def planned(self):
+        """Generate (name, sql, plan, searches, sorted) of every SELECT of every call"""
+        for name, call, searches, is_sorted in self.calls():
+            selects = capture_selects(call)
+            self.assertTrue(selects, name)
+            for sql, params in selects:
+                yield name, sql, explain(sql, params), searches, is_sorted
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite only')
+    def test_sqlite_plans(self):
+        plans = {}
+        for name, sql, plan, searches, is_sorted in self.planned():
+            with self.subTest(call=name, sql=sql):
+                # Subqueries scan aliases, e.g. U0, so only registries may be scanned
+                for scanned in re.findall(r'^SCAN (?:TABLE )?(\S+)', plan, re.M):
+                    self.assertIn(scanned, SMALL_TABLES, plan)
+                if not is_sorted:
+                    self.assertNotIn('TEMP B-TREE', plan)
+            plans.setdefault(name, []).append(plan)
+        for name, _, searches, _ in self.calls():
+            plan = '\n'.join(plans[name])
+            for table, columns in searches:
+                with self.subTest(call=name, table=table, columns=columns):
+                    searched = r'USING (COVERING )?INDEX \S*%s\S* \(%s' % (
+                        table, ' AND '.join(r'%s[=>]\?' % column for column in columns))
+                    self.assertRegex(plan, searched)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+    def test_postgresql_plans(self):
+        plans = {}
+        for name, sql, plan, searches, is_sorted in self.planned():
+            with self.subTest(call=name, sql=sql):
+                for scanned in re.findall(r'Seq Scan on (\S+)', plan):
+                    self.assertIn(scanned, SMALL_TABLES, plan)
+                if not is_sorted:
+                    self.assertNotIn('Sort', plan)
+            plans.setdefault(name, []).append(plan)
+        for name, _, searches, _ in self.calls():
+            plan = '\n'.join(plans[name])
+            for table, columns in searches:
+                for column in columns:
+                    with self.subTest(call=name, table=table, column=column):
+                        self.assertRegex(plan, r'Index Cond: .*\b%s\b' % column)
+
+    def test_traversal_is_not_sorted(self):
+        self.assertNotIn('ORDER BY', str(Relationship.as_end(self.rel_type, self.top, 'tail').query))
+        self.assertNotIn('ORDER BY', str(Relationship.tail_only(self.rel_type).query))
+        self.assertNotIn('ORDER BY', str(OrganisationClosure._edges().query))
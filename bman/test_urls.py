@@ -71,3 +71,7 @@ class UrlTestCase(unittest.TestCase):
 
         url = reverse('api-object-method', kwargs=self.kwargs_with_method)
         self.assertEqual(url, '/api' + self.url_with_method)
+
+    def test_directory_is_not_a_target(self):
+        self.assertEqual(resolve('/api/directory/').view_name, 'api-directory')
+        self.assertEqual(reverse('api-directory'), '/api/directory/')
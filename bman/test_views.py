@@ -2,6 +2,8 @@
 Unit tests for views.
 """
 import json
+from unittest.mock import patch
+
 from django.test import TestCase, Client
 
 from bman.models import Person
@@ -28,6 +30,46 @@ class ViewTestCase(TestCase):
         response = c.get('/objects/Relationship/')
         self.assertEqual(response.status_code, 200)
 
+    def test_get_relationship_objects(self):
+        from bman.models import RelationshipType, Relationship
+        RelationshipType.objects.create(name='Supervision', entity_tail='person', entity_head='person',
+                                        forward='supervises', backward='studies from')
+        Relationship.objects.create(tail_id=1, head_id=2, relationshiptype='Supervision')
+        c = Client()
+        response = c.get('/objects/Relationship/')
+        self.assertContains(response, 'John Smith supervises John Brother Smith')
+
+    def test_person_detail_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from bman.models import RelationshipType, Relationship, Organisation, Role
+        employment, study, _ = [RelationshipType.objects.create(name=name, entity_tail=tail, entity_head=head)
+                                for name, tail, head in (('Employment', 'organisation', 'person'),
+                                                         ('Study', 'organisation', 'person'),
+                                                         ('Supervision', 'role', 'role'))]
+        org = Organisation.objects.create(name='University of Adelaide')
+        supervisor = Person.objects.get(pk=1)
+        employee = Role.objects.create(person=supervisor, organisation=org, relationshiptype=employment)
+
+        def add_student(first_name):
+            person = Person.objects.create(first_name=first_name, last_name='Doe')
+            student = Role.objects.create(person=person, organisation=org, relationshiptype=study)
+            Relationship.objects.create(tail_id=employee.pk, head_id=student.pk, relationshiptype='Supervision')
+
+        add_student('Jane')
+        Role.objects.create(person=supervisor, organisation=org, relationshiptype=study)
+        c = Client()
+        with CaptureQueriesContext(connection) as few:
+            response = c.get('/objects/person/1/')
+        self.assertContains(response, 'Jane Doe')
+        for first_name in ('Jim', 'Joe', 'Jack'):
+            add_student(first_name)
+        Role.objects.create(person=supervisor, organisation=org, relationshiptype=employment)
+        with CaptureQueriesContext(connection) as many:
+            response = c.get('/objects/person/1/')
+        self.assertContains(response, 'Jack Doe')
+        self.assertEqual(len(many), len(few))
+
     def test_get_object(self):
         #Only test url and view. Do not care instance yet
         from django.core.exceptions import ObjectDoesNotExist
@@ -77,3 +119,221 @@ class ViewTestCase(TestCase):
         persons = json.loads(str(response.content,'utf-8'))
         for person in persons:
             self.assertEqual(person['last_name'], 'Smith')
+
+    def test_api_organisation_root_ids(self):
+        from bman.models import Organisation
+        orgs = [Organisation.objects.create(name=name) for name in ('University of Adelaide', 'School')]
+        c = Client()
+        response = c.get('/api/organisation/?method=get_root_ids&ids=%d;%d' % (orgs[0].pk, orgs[1].pk))
+        self.assertEqual(response.status_code, 200)
+        roots = json.loads(str(response.content, 'utf-8'))
+        self.assertEqual(roots, {str(org.pk): org.pk for org in orgs})
+
+    def test_api_organisation_billing_organisations(self):
+        from bman.models import RelationshipType, Organisation, Role, Account
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person_id=1, organisation=org, relationshiptype=rel_type)
+        Account.objects.create(role=role, username='john', billing_org=org)
+        c = Client()
+        for _ in range(2):
+            # the same when ids are cached
+            response = c.get('/api/organisation/?method=get_billing_organisations')
+            self.assertEqual(response.status_code, 200)
+            billers = json.loads(str(response.content, 'utf-8'))
+            self.assertEqual([(biller['pk'], biller['name']) for biller in billers],
+                             [(org.pk, 'University of Adelaide')])
+
+    def test_api_organisation_services_stream(self):
+        from bman.models import RelationshipType, Organisation, Role, Account, Nectar
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person_id=1, organisation=org, relationshiptype=rel_type)
+        Account.objects.create(role=role, username='john', billing_org=org)
+        Nectar.objects.create(contractor=role, openstack_id='abc', tenant='project')
+        c = Client()
+        response = c.get('/api/organisation/%d/iter_services/' % org.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        services = json.loads(str(b''.join(response.streaming_content), 'utf-8'))
+        self.assertEqual([service['tenant'] for service in services], ['project'])
+
+    def test_api_directory(self):
+        from bman.models import RelationshipType, Organisation, Role, Account
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person_id=1, organisation=org, relationshiptype=rel_type, email='john@example.com')
+        Account.objects.create(role=role, username='john', billing_org=org)
+        c = Client()
+        response = c.get('/api/directory/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(str(response.content, 'utf-8')), {'john': dict(
+            role_id=role.pk, fullname='John Smith', organisation='University of Adelaide',
+            billing_organisation='University of Adelaide', email='john@example.com')})
+
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            self.assertEqual(c.get('/api/directory/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Saves which do not change the directory keep the ETag
+        Person.objects.filter(pk=1).get().save()
+        self.assertEqual(c.get('/api/directory/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Role.objects.filter(pk=role.pk).update(email='js@example.com')
+        Organisation.objects.get(pk=org.pk).save()
+        response = c.get('/api/directory/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_directory_expires(self):
+        from django.core.cache import cache
+        from django.test import override_settings
+        from bman.models import RelationshipType, Organisation, Role, Account
+        from bman.models import directory
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person_id=1, organisation=org, relationshiptype=rel_type)
+        with override_settings(BMAN_DIRECTORY_TIMEOUT=30), patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            etag, _ = directory.get_directory()
+        self.assertEqual(cache_set.call_args[0][2], 30)
+        # A change by another process is not signalled, it is seen once the directory has expired
+        Account.objects.bulk_create([Account(role=role, username='john', billing_org=org)])
+        self.assertEqual(directory.get_directory()[0], etag)
+        cache.delete(directory.DIRECTORY_KEY)
+        new_etag, content = directory.get_directory()
+        self.assertNotEqual(new_etag, etag)
+        self.assertIn('john', json.loads(content))
+
+    def test_api_services_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from bman.models import RelationshipType, Organisation, Role, Account, RDS
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person_id=1, organisation=org, relationshiptype=rel_type)
+        Account.objects.create(role=role, username='john', billing_org=org)
+        c = Client()
+        counts = []
+        for i in range(3):
+            RDS.objects.create(contractor=role, allocation_num=str(i), collection_name='data')
+            with CaptureQueriesContext(connection) as queries:
+                response = c.get('/api/rds/?status=E')
+            counts.append(len(queries))
+        services = json.loads(str(response.content, 'utf-8'))
+        self.assertEqual(services, [service.to_dict() for service in RDS.objects.all()])
+        self.assertEqual(counts, [counts[0]] * 3)
+
+    def test_api_ownership(self):
+        from bman.models import RelationshipType, Organisation, Role, RDS
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person_id=1, organisation=org, relationshiptype=rel_type)
+        RDS.objects.create(contractor=role, allocation_num='RDS-1', collection_name='data')
+        c = Client()
+        response = c.get('/api/ownership/?billing_org_id=%d' % org.pk)
+        self.assertEqual([row['identifier'] for row in json.loads(str(response.content, 'utf-8'))], ['RDS-1'])
+        response = c.get('/api/ownership/?group_by=billing_org_id&service_type=RDS')
+        self.assertEqual(json.loads(str(response.content, 'utf-8')),
+                         [{'billing_org_id': org.pk, 'service_type': 'RDS', 'count': 1}])
+        self.assertEqual(c.get('/api/ownership/?group_by=identifier').status_code, 400)
+
+    def test_api_search(self):
+        c = Client()
+        response = c.get('/api/search/?q=john+smi&entity=person')
+        self.assertEqual([result['name'] for result in json.loads(str(response.content, 'utf-8'))],
+                         ['John Smith', 'John Brother Smith'])
+        self.assertEqual(c.get('/api/search/?q=john&entity=role').status_code, 400)
+
+    def test_form_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from bman.models import RelationshipType, Organisation, Role, Account
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person_id=1, organisation=org, relationshiptype=rel_type)
+        account = Account.objects.create(role=role, username='john', billing_org=org)
+        c = Client()
+        pages = ('/forms/account/', '/forms/account/%d/' % account.pk, '/forms/rds/', '/forms/role/%d/' % role.pk)
+        # Loads the relationship type of the role into the registry
+        str(role)
+        counts = []
+        for i in range(2):
+            with CaptureQueriesContext(connection) as queries:
+                for page in pages:
+                    self.assertEqual(c.get(page).status_code, 200)
+            counts.append(len(queries))
+            for j in range(5):
+                person = Person.objects.create(first_name='Jane', last_name='Doe %d%d' % (i, j))
+                Role.objects.create(person=person, organisation=org, relationshiptype=rel_type)
+                Organisation.objects.create(name='Faculty %d%d' % (i, j))
+        self.assertEqual(counts, [counts[0]] * 2)
+        response = c.get('/forms/account/%d/' % account.pk)
+        self.assertContains(response, 'value="%s"' % role)
+        self.assertNotContains(response, 'Jane Doe')
+        response = c.post('/forms/account/%d/' % account.pk,
+                          {'role': role.pk, 'username': 'johns', 'status': 'A', 'billing_org': ''})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Account.objects.get(pk=account.pk).username, 'johns')
+
+    def test_api_lookup(self):
+        from bman.models import RelationshipType, Organisation, Role
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person',
+                                                   forward='employs')
+        org = Organisation.objects.create(name='University of Adelaide')
+        role = Role.objects.create(person_id=1, organisation=org, relationshiptype=rel_type)
+        Role.objects.create(person_id=2, organisation=org, relationshiptype=rel_type)
+        c = Client()
+        response = c.get('/api/lookup/role/?q=adel+john+smi')
+        self.assertEqual(len(json.loads(str(response.content, 'utf-8'))), 2)
+        response = c.get('/api/lookup/role/?q=adel+smith+john&limit=1')
+        self.assertEqual(json.loads(str(response.content, 'utf-8')),
+                         [{'id': role.pk, 'label': 'University of Adelaide employs John Smith'}])
+        response = c.get('/api/lookup/organisation/?q=univ')
+        self.assertEqual(json.loads(str(response.content, 'utf-8')),
+                         [{'id': org.pk, 'label': 'University of Adelaide'}])
+        self.assertEqual(json.loads(str(c.get('/api/lookup/person/?q=nobody').content, 'utf-8')), [])
+        self.assertEqual(c.get('/api/lookup/catalog/?q=x').status_code, 400)
+        self.assertEqual(c.get('/api/lookup/account/?q=john').status_code, 400)
+
+    def test_api_organisation_all_roles(self):
+        from bman.models import RelationshipType, Relationship, Organisation, Role
+        RelationshipType.objects.create(name='Organisation', entity_tail='organisation', entity_head='organisation')
+        employment = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        top = Organisation.objects.create(name='University of Adelaide')
+        school = Organisation.objects.create(name='School of Physics')
+        Relationship.objects.create(tail_id=top.pk, head_id=school.pk, relationshiptype='Organisation')
+        student = Role.objects.create(person_id=2, organisation=school, relationshiptype=employment)
+        staff = Role.objects.create(person_id=1, organisation=top, relationshiptype=employment)
+        c = Client()
+        response = c.get('/api/organisation/%d/get_all_roles/' % top.pk)
+        self.assertEqual(response.status_code, 200)
+        roles = json.loads(str(response.content, 'utf-8'))
+        self.assertEqual([(role['id'], role['organisation'], role['full_name']) for role in roles],
+                         [(staff.pk, 'University of Adelaide', 'John Smith'),
+                          (student.pk, 'School of Physics', 'John Brother Smith')])
+        self.assertEqual(set(roles[0].keys()), set(staff.to_dict().keys()))
+
+    def test_api_organisation_service(self):
+        from bman.models import RelationshipType, Organisation, Role, Account, RDS
+        rel_type = RelationshipType.objects.create(name='Employment', entity_tail='organisation', entity_head='person')
+        org = Organisation.objects.create(name='University of Adelaide')
+        for person_id in (1, 2):
+            role = Role.objects.create(person_id=person_id, organisation=org, relationshiptype=rel_type)
+            Account.objects.create(role=role, username='user%d' % person_id, billing_org=org)
+            for i in range(person_id):
+                RDS.objects.create(contractor=role, allocation_num='RDS%d-%d' % (person_id, i), collection_name='data')
+        c = Client()
+        response = c.get('/api/organisation/%d/get_service/?name=rds' % org.pk)
+        self.assertEqual(response.status_code, 200)
+        services = json.loads(str(response.content, 'utf-8'))
+        # A list per account of its services as in to_dict
+        self.assertEqual([[service['allocation_num'] for service in group] for group in services],
+                         [['RDS1-0'], ['RDS2-0', 'RDS2-1']])
+        self.assertEqual(services[0][0], RDS.objects.get(allocation_num='RDS1-0').to_dict())
+
+    def test_api_organisation_rollup(self):
+        from bman.models import Organisation
+        org = Organisation.objects.create(name='University of Adelaide')
+        c = Client()
+        response = c.get('/api/organisation/%d/get_rollup/' % org.pk)
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(str(response.content, 'utf-8'))
+        self.assertEqual(report[str(org.pk)]['total']['roles'], 0)
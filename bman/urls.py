@@ -7,6 +7,11 @@ urlpatterns = [
     url(r'^forms/(?P<target>\w+)/(?P<id>\w+)/$', views.FormsUpdateView.as_view(), name='update-forms'),
     url(r'^objects/(?P<target>\w+)/$', views.ObjectList.as_view(), name='objects'),
     url(r'^objects/(?P<target>\w+)/(?P<id>\w+)/$', views.ObjectsView.as_view(), name='object'),
+    # Before api patterns of models so these are not taken as targets
+    url(r'^api/directory/$', views.directory, name='api-directory'),
+    url(r'^api/ownership/$', views.ownership, name='api-ownership'),
+    url(r'^api/search/$', views.search, name='api-search'),
+    url(r'^api/lookup/(?P<target>\w+)/$', views.lookup, name='api-lookup'),
     url(r'^api/(?P<target>\w+)/$', views.ApiObjectsView.as_view(), name='api-objects'),
     url(r'^api/(?P<target>\w+)/(?P<id>\w+)/$', views.ApiObjectsView.as_view(), name='api-object'),
     url(r'^api/(?P<target>\w+)/(?P<id>\w+)/(?P<method>\w+)/$', views.ApiObjectsView.as_view(), name='api-object-method'),
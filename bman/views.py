@@ -9,7 +9,7 @@ from django.views.generic.edit import CreateView, UpdateView
 from django.shortcuts import render
 from django.core.urlresolvers import reverse
 from django.http import (
-    HttpResponse, HttpResponseBadRequest,
+    HttpResponse, HttpResponseBadRequest, StreamingHttpResponse,
     JsonResponse, Http404
 )
 
@@ -17,7 +17,12 @@ import django.db
 from django.core import serializers
 from django.forms.models import model_to_dict
 
+from django.views.decorators.http import condition, require_GET
+
 from .forms import * # NOQA
+from .models import Role, ServiceOwnership
+from .models import directory as account_directory
+from .models import search as name_search
 
 FORM_MODULE_NAME = __name__.split('.')[0] + '.forms'
 
@@ -107,19 +112,94 @@ class FormsUpdateView(SkeletonView, UpdateView):
     template_name = 'generic_form.html'
 
 
+def person_detail_context(person):
+    """Get everything person_detail.html shows in a fixed number of queries
+
+       roles is a list of (role, supervisors, students) and services a list of all
+       services of the person.
+    """
+    roles = list(person.role_set.select_related('organisation', 'relationshiptype'))
+    supervision = Role.get_supervision(roles)
+    return {
+        'roles': [(role, supervision[role.pk]['supervisors'], supervision[role.pk]['students']) for role in roles],
+        'services': person.get_all_services()
+    }
+
+
 class ObjectsView(SkeletonView, DetailView):
     """View class for reading object or objects"""
     template_name = 'generic_detail.html'
     TEMPLATES = {'Person': 'person_detail.html',
                  'Organisation': 'organisation_detail.html'}
+    # Precompute data templates use, so pages do not query for every related object
+    CONTEXTS = {'Person': person_detail_context}
 
     def get_template_names(self):
         return self.TEMPLATES.get(_form_to_model(self.form_class.__name__), self.template_name)
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        build = self.CONTEXTS.get(_form_to_model(self.form_class.__name__))
+        if build:
+            context.update(build(self.object))
+        return context
+
 
 class ObjectList(SkeletonView, ListView):
     """View class for reading object or objects"""
     template_name = 'generic_list.html'
+    # Load related objects used in string representations of models in batches
+    QUERYSETS = {'Relationship': lambda queryset: queryset.with_ends(),
+                 'Role': lambda queryset: queryset.select_related('person', 'organisation'),
+                 'Account': lambda queryset: queryset.select_related('role__person')}
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        prepare = self.QUERYSETS.get(_form_to_model(self.form_class.__name__))
+        return prepare(queryset) if prepare else queryset
+
+
+@require_GET
+@condition(etag_func=lambda request: account_directory.get_directory()[0])
+def directory(request):
+    """All account usernames with their people and organisations, 304 when If-None-Match is current"""
+    _, content = account_directory.get_directory()
+    response = HttpResponse(content, content_type="application/json")
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+@require_GET
+def ownership(request):
+    """Rows of ServiceOwnership filtered by query parameters, e.g. ?billing_org_id=1&service_type=RDS
+
+       With group_by, counts of services of each type in groups are returned instead.
+    """
+    filters = request.GET.dict()
+    group_by = filters.pop('group_by', None)
+    try:
+        if group_by:
+            data = ServiceOwnership.summarise(group_by, **filters)
+        else:
+            data = [row.to_dict() for row in ServiceOwnership.search(**filters).order_by('service_type', 'service_id')]
+    except ValueError as e:
+        return JsonResponse({'message': str(e)}, status=400)
+    response = JsonResponse(data, safe=False)
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+@require_GET
+def search(request):
+    """People and organisations with names matching words of ?q=, e.g. ?q=john+smi&entity=person&limit=10"""
+    try:
+        data = name_search.search(request.GET.get('q', ''), request.GET.get('entity'),
+                                  request.GET.get('limit', 20))
+    except ValueError as e:
+        return JsonResponse({'message': str(e)}, status=400)
+    response = JsonResponse(data, safe=False)
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
 
 
 # Valid data, how to reuse form class' validator?
@@ -157,7 +237,11 @@ class ApiObjectsView(SkeletonView):
             if 'method' in self.kwargs:
                 method = self.kwargs.pop('method')
                 method_data = getattr(query_target, method)(**self.kwargs)
-                if isinstance(method_data, django.db.models.query.QuerySet):
+                if inspect.isgenerator(method_data):
+                    response = StreamingHttpResponse(self._stream(method_data), content_type="application/json")
+                    response["Access-Control-Allow-Origin"] = "*"
+                    return response
+                elif isinstance(method_data, django.db.models.query.QuerySet):
                     data = self._repack(serializers.serialize('json', method_data))
                 else:
                     data = self._prepare(method_data)
@@ -221,6 +305,17 @@ class ApiObjectsView(SkeletonView):
         else:
             return JsonResponse({'message': 'Missing id'}, status=400)
 
+    def _stream(self, items):
+        """Yield a JSON list in pieces, one for each item of a generator"""
+        yield '['
+        for i, item in enumerate(items):
+            if hasattr(item, 'to_dict'):
+                item = item.to_dict()
+            elif isinstance(item, django.db.models.Model):
+                item = model_to_dict(item)
+            yield (',' if i else '') + json.dumps(item)
+        yield ']'
+
     def _prepare(self, data):
         """Prepare data to be jsonfied"""
         def _generator(data):
@@ -228,6 +323,9 @@ class ApiObjectsView(SkeletonView):
                 converted = data.to_dict()
             elif isinstance(data, django.db.models.Model):
                 converted = model_to_dict(data)
+            elif isinstance(data, django.db.models.QuerySet) and hasattr(data.model, 'to_dicts'):
+                # Models which convert querysets with their related objects loaded in batches
+                converted = data.model.to_dicts(data)
             elif isinstance(data, list) or isinstance(data, django.db.models.QuerySet):
                 converted = [_generator(d) for d in data]
             else:
@@ -240,7 +338,7 @@ class ApiObjectsView(SkeletonView):
         elif isinstance(data, django.db.models.Model):
             converted = _generator(data)
         elif isinstance(data, django.db.models.QuerySet):
-            converted = [_generator(d) for d in data]
+            converted = _generator(data)
         else:
             # might be a base type
             converted = data
@@ -272,3 +370,13 @@ class ApiObjectsView(SkeletonView):
             data[i] = serialized[i]['fields']
             data[i]['pk'] = serialized[i]['pk']
         return json.dumps(data)
+
+
+@require_GET
+def lookup(request, target):
+    """Candidates of autocomplete fields of forms, e.g. /api/lookup/role/?q=smi returns [{id, label}]"""
+    try:
+        data = name_search.lookup(target, request.GET.get('q', ''), request.GET.get('limit', 20))
+    except ValueError as e:
+        return JsonResponse({'message': str(e)}, status=400)
+    return JsonResponse(data, safe=False)
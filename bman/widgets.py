@@ -0,0 +1,43 @@
+"""Widgets of forms
+
+AutocompleteSelect replaces the select of a large ForeignKey: a select has an option of
+every row of the related table, this only has the label of the current value and looks
+up candidates from /api/lookup/<target>/ as the user types.
+"""
+from django.core.urlresolvers import reverse
+from django.forms import Widget
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+
+from .models import search as name_search
+
+
+class AutocompleteSelect(Widget):
+    """A text input searching target, 'person', 'organisation' or 'role', with a hidden input of the id
+
+       The script in generic_form.html fills the list of candidates and copies the id
+       of the chosen one to the hidden input.
+    """
+
+    def __init__(self, target, attrs=None):
+        super().__init__(attrs)
+        self.target = target
+
+    def id_for_label(self, id_):
+        # Labels go to the input people type in
+        return '%s_text' % id_ if id_ else id_
+
+    def render(self, name, value, attrs=None):
+        attrs = self.build_attrs(attrs)
+        widget_id = attrs.pop('id', 'id_%s' % name)
+        label = name_search.get_label(self.target, value)
+        text_attrs = dict(attrs, type='text', autocomplete='off', list='%s_list' % widget_id,
+                          value=label or '', placeholder='Type to search')
+        text_attrs['class'] = ' '.join(filter(None, [attrs.get('class'), 'autocomplete']))
+        text_attrs['data-url'] = reverse('api-lookup', kwargs={'target': self.target})
+        text_attrs['data-for'] = widget_id
+        text_attrs['id'] = self.id_for_label(widget_id)
+        return format_html(
+            '<input type="hidden" id="{0}" name="{1}" value="{2}" />'
+            '<input{3} /><datalist id="{0}_list"></datalist>',
+            widget_id, name, value if label is not None else '', flatatt(text_attrs))